@@ -15,6 +15,8 @@ from dipy.core.gradients import check_multi_b
 import nrrd
 import pandas as pd
 import numpy as np
+import multiprocessing
+import signal
 PRECISION= 5
 np.set_printoptions(precision= PRECISION, suppress= True, floatmode= 'maxprec')
 
@@ -25,6 +27,11 @@ from conversion import num2str
 
 eps= 2.204e-16
 inf= 65535.
+GRAD_CHUNK= 16 # gradients per chunk for minOverGrads
+FIT_CHUNK= 5000 # voxels per block for DTI/DKI fitting
+
+# models of the current process, built once by _init_models()
+_MODELS= {}
 
 def save_map(outFile, img, affine= None, hdr= None):
 
@@ -67,6 +74,121 @@ def mask_calc(M, interval):
     C= a | b
     return C*1
 
+def min_over_grads(data, bse, where_dwi, mask, chunk=GRAD_CHUNK):
+    '''1/b0 * min_i(b0-Gi) for the voxels in mask only, as a 1D vector in the order of np.flatnonzero(mask).
+    Gradients are read in chunks and reduced into a running minimum,
+    so the largest temporary array is voxels in mask x chunk.'''
+
+    vox= np.flatnonzero(mask)
+    data= data.reshape(-1, data.shape[-1])
+
+    b0= bse.ravel()[vox]
+    # prevent division by zero during normalization
+    b0[b0 < 1] = 1.
+
+    low= np.full(len(vox), np.inf)
+    for i in range(0, len(where_dwi), chunk):
+        grads= where_dwi[i:i+chunk]
+        np.minimum(low, (b0[:, None]- data[vox[:, None], grads]).min(axis=1), out=low)
+
+    return low/b0
+
+
+def _init_models(bvals, bvecs, mkFlag):
+
+    gtab= gradient_table(bvals, bvecs)
+    _MODELS['dti']= dti.TensorModel(gtab)
+    if mkFlag:
+        _MODELS['dki']= dki.DiffusionKurtosisModel(gtab)
+    else:
+        _MODELS.pop('dki', None)
+
+
+def _fit_block(block):
+
+    dtifit= _MODELS['dti'].fit(block)
+    maps= {'evals': dtifit.evals, 'fa': dtifit.fa, 'md': dtifit.md, 'ad': dtifit.ad, 'rd': dtifit.rd}
+    if 'dki' in _MODELS:
+        # http://nipy.org/dipy/examples_built/reconst_dki.html
+        maps['mk']= _MODELS['dki'].fit(block).mk(0,3)
+
+    return maps
+
+
+def fit_models(data, mask, bvals, bvecs, mkFlag, nproc=1, chunk=FIT_CHUNK):
+    '''Fit DTI, and DKI if mkFlag, to the voxels in mask in blocks of chunk voxels over nproc processes.
+    At most 2*nproc blocks are in flight, so memory is bounded by the block size rather than the volume.
+    Returns {evals, fa, md, ad, rd, mk}, each map is zero outside the mask'''
+
+    vox= np.flatnonzero(mask)
+    data= data.reshape(-1, data.shape[-1])
+    starts= range(0, len(vox), chunk)
+
+    maps= {name: np.zeros((mask.size, 3) if name=='evals' else mask.size)
+           for name in ['evals', 'fa', 'md', 'ad', 'rd']+ (['mk'] if mkFlag else [])}
+
+    def _collect(start, res):
+        for name, x in res.items():
+            maps[name][vox[start:start+chunk]]= x
+
+    if nproc==1:
+        _init_models(bvals, bvecs, mkFlag)
+        for start in starts:
+            _collect(start, _fit_block(data[vox[start:start+chunk]]))
+
+    else:
+        sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool= multiprocessing.Pool(nproc, initializer=_init_models, initargs=(bvals, bvecs, mkFlag))
+        signal.signal(signal.SIGINT, sigint_handler)
+        try:
+            for i in range(0, len(starts), 2*nproc):
+                wave= starts[i:i+2*nproc]
+                for start, res in zip(wave, pool.map(_fit_block, [data[vox[s:s+chunk]] for s in wave])):
+                    _collect(start, res)
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    return {name: x.reshape(mask.shape+x.shape[1:]) for name, x in maps.items()}
+
+
+def label_stats(labelMap, labels, means, totals):
+    '''Statistics of all labels computed together, one bincount per map instead of one scan per label.
+    labels are matched as labelMap==int(label)
+    means: {name: map} for which mean and std are computed
+    totals: {name: map} for which sum is computed
+    Returns {name: (mean, std)} and {name: sum}, each value has one element per label'''
+
+    values, inverse= np.unique(labelMap, return_inverse=True)
+    inverse= inverse.ravel()
+
+    # index of each label in values, labels absent from labelMap get an empty bin
+    labels= np.array([int(label) for label in labels])
+    pos= np.minimum(np.searchsorted(values, labels), len(values)-1)
+    pos[values[pos]!=labels]= len(values)
+
+    count= np.bincount(inverse, minlength=len(values)+1)
+
+    stats= {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, x in means.items():
+            x= x.ravel()
+            # mean of an empty label is nan, same as x[roi].mean()
+            mean= np.bincount(inverse, weights=x, minlength=len(values)+1)/count
+            # two pass variance, same as x[roi].std()
+            var= np.bincount(inverse, weights=(x-mean[inverse])**2, minlength=len(values)+1)/count
+            stats[name]= (mean[pos], np.sqrt(var)[pos])
+
+    sums= {name: np.bincount(inverse, weights=x.ravel(), minlength=len(values)+1)[pos]
+           for name, x in totals.items()}
+
+    return stats, sums
+
+
 def form_bins(interval):
 
     # interval= []
@@ -129,6 +251,15 @@ class quality(cli.Application):
                          help='look up table for specified labelMap (atlas), default: FreeSurferColorLUT.txt')
     name= cli.SwitchAttr(['-n', '--name'], help='labelMap name (e.g WhiteMatter, GrayMatter etc.)')
 
+    N_proc= cli.SwitchAttr('--nproc', help='number of processes for DTI/DKI fitting', default= 1)
+    chunk= cli.SwitchAttr('--chunk', help='number of voxels fitted at a time by each process, '
+                          'reduce it if you run into memory error', default= FIT_CHUNK)
+
+    # set by dwi_quality_batch.py to share the parsed LUT among cases, {label: region} for labels of labelMap
+    label2name= None
+    # ROI based statistics DataFrame, set by main() for in-process callers
+    stats= None
+
     def main(self):
 
         self.imgFile= str(self.imgFile)
@@ -188,26 +319,22 @@ class quality(cli.Application):
 
         gtab = gradient_table(bvals, bvecs)
 
-        dtimodel= dti.TensorModel(gtab)
-        dtifit= dtimodel.fit(data, mask_data)
-        evals= dtifit.evals
-        fa= dtifit.fa
-        md= dtifit.md
-        ad= dtifit.ad
-        rd= dtifit.rd
+        mkFlag= check_multi_b(gtab,n_bvals=3)
+        if not mkFlag:
+            warnings.warn("DIPY DKI requires at least 3 b-shells (which can include b=0), "
+                             "kurtosis quality cannot be computed.")
+
+        maps= fit_models(data, mask_data>0, bvals, bvecs, mkFlag, int(self.N_proc), int(self.chunk))
+        evals= maps['evals']
+        fa= maps['fa']
+        md= maps['md']
+        ad= maps['ad']
+        rd= maps['rd']
         evals_zero= evals<0.
         evals_zero_mask= (evals_zero[...,0] | evals_zero[...,1] | evals_zero[...,2])*1
 
-
-        mkFlag= check_multi_b(gtab,n_bvals=3)
         if mkFlag:
-            dkimodel = dki.DiffusionKurtosisModel(gtab)
-            dkifit = dkimodel.fit(data, mask_data)
-            mk = dkifit.mk(0,3) # http://nipy.org/dipy/examples_built/reconst_dki.html
-
-        else:
-            warnings.warn("DIPY DKI requires at least 3 b-shells (which can include b=0), "
-                             "kurtosis quality cannot be computed.")
+            mk= maps['mk']
 
 
         fa_mask= mask_calc(fa, self.fa_low_high)
@@ -219,14 +346,11 @@ class quality(cli.Application):
         b0File= outPrefix + '_b0' + outFormat
         save_map(b0File, bse_data, affine, hdr)
 
-        # prevent division by zero during normalization
-        bse_data[bse_data < 1] = 1.
-        extend_bse = np.expand_dims(bse_data, grad_axis)
-        extend_bse = np.repeat(extend_bse, len(where_dwi), grad_axis)
-        curtail_dwi = np.take(data, where_dwi, axis=grad_axis)
-
         # 1 / b0 * min(b0 - Gi)
-        minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / bse_data
+        # voxels outside the mask have b0=Gi=0, b0 is raised to 1, so they are (1-0)/1 in minOverGrads
+        inside= mask_data>0
+        minOverGrads = np.ones(inside.shape)
+        minOverGrads[inside] = min_over_grads(data, bse_data, where_dwi, inside)
 
         # another way to prevent division by zero: 1/b0 * min(b0-Gi) with condition at b0~eps
         # minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / (bse_data + eps)
@@ -315,7 +439,10 @@ class quality(cli.Application):
 
             outLabelMap = nib.load(outLabelMapFile).get_data()
             labels = np.unique(outLabelMap)[1:]
-            label2name = parse_labels(labels, self.lut._path if self.lut else None)
+            if self.label2name is None:
+                label2name = parse_labels(labels, self.lut._path if self.lut else None)
+            else:
+                label2name = {label: name for label, name in self.label2name.items() if int(label) in labels}
 
             print('Creating ROI based statistics ...')
             stat_file= outPrefix + f'_{self.name}_stat.csv'
@@ -325,15 +452,18 @@ class quality(cli.Application):
                                                 'total_{min_i(b0-Gi)<0}','total_evals<0',
                                                 'MK_mean','MK_std',])
 
+            stats, sums= label_stats(outLabelMap, label2name.keys(),
+                                     {'fa': fa, 'md': md, 'ad': ad, 'rd': rd, 'mk': mk},
+                                     {'minOverGrads': minOverGradsNegativeMask, 'evals': evals_zero_mask})
+
             for i,label in enumerate(label2name.keys()):
-                roi = outLabelMap == int(label)
-
-                properties= [num2str(x) for x in [fa[roi>0].mean(), fa[roi>0].std(),
-                                                  md[roi>0].mean(), md[roi>0].std(),
-                                                  ad[roi>0].mean(), ad[roi>0].std(),
-                                                  rd[roi>0].mean(), rd[roi>0].std(),
-                                                  minOverGradsNegativeMask[roi>0].sum(), evals_zero_mask[roi>0].sum(),
-                                                  mk[roi>0].mean(), mk[roi>0].std()]
+
+                properties= [num2str(x) for x in [stats['fa'][0][i], stats['fa'][1][i],
+                                                  stats['md'][0][i], stats['md'][1][i],
+                                                  stats['ad'][0][i], stats['ad'][1][i],
+                                                  stats['rd'][0][i], stats['rd'][1][i],
+                                                  int(sums['minOverGrads'][i]), int(sums['evals'][i]),
+                                                  stats['mk'][0][i], stats['mk'][1][i]]
                              ]
 
 
@@ -344,6 +474,8 @@ class quality(cli.Application):
             df.to_csv(stat_file)
             print('See ', os.path.abspath(stat_file))
 
+            self.stats= df
+
 if __name__=='__main__':
     quality.run()
 
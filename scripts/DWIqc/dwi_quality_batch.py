@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
-# from conversion.dwi_quality import quality
-from plumbum import cli
-from os.path import dirname, join, basename, abspath, isdir
+from dwi_quality import quality
+from plumbum import cli, local
+from os.path import dirname, join, basename, abspath, isdir, splitext
 from os import mkdir
 from shutil import rmtree
+from tempfile import mkdtemp
+from multiprocessing.util import Finalize
 import psutil
-import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import traceback
+import warnings
 import pandas as pd
 import nibabel as nib
 import numpy as np
@@ -14,19 +18,107 @@ from conversion import parse_labels, read_imgs_masks, num2str
 from subprocess import check_call
 SCRIPTDIR=dirname(__file__)
 
+STAT_COLUMNS= ['FA_mean', 'FA_std', 'MD_mean', 'MD_std',
+               'AD_mean', 'AD_std', 'RD_mean', 'RD_std',
+               'total_{min_i(b0-Gi)<0}', 'total_evals<0',
+               'MK_mean', 'MK_std']
+
+# template, labelMap and labelMap regions shared by all cases of a worker, set by _init_worker()
+_LABEL2NAME= {}
+_STAGED= {}
+
+
+def labelmap_regions(labelMapFile, lut):
+    '''{label: region} for the labels in labelMapFile, except background'''
+
+    outLabelMap = nib.load(labelMapFile).get_data()
+    labels = np.unique(outLabelMap)[1:]
+
+    return parse_labels(labels, lut)
+
+
+def _init_worker(template, labelMap, label2name):
+    '''Load the template and labelMap once per worker and keep them as uncompressed nifti in a directory
+    of the worker, so that the registration and warping of each case read them without decompressing again'''
+
+    if template and labelMap:
+        staging= mkdtemp(prefix='dwi_quality-')
+        # removed when the worker exits
+        Finalize(None, rmtree, args=(staging,), exitpriority=0)
+        for key, imgFile in [('template', template), ('labelMap', labelMap)]:
+            _STAGED[key]= join(staging, key+'.nii')
+            nib.save(nib.load(imgFile), _STAGED[key])
+
+    _LABEL2NAME.update(label2name)
+
+
+def dwi_quality_case(imgPath, maskPath, bvalFile, bvecFile,
+                     mk_low_high, fa_low_high, md_low_high, out_dir, name, template, labelMap, lut, fit_nproc=1):
+    '''Run dwi_quality.py in this process, returns the ROI based statistics DataFrame of the case'''
+
+    app= quality(join(SCRIPTDIR, 'dwi_quality.py'))
+    app.imgFile= imgPath
+    app.maskFile= maskPath
+    app.bvalFile= bvalFile
+    app.bvecFile= bvecFile
+    app.mk_low_high= mk_low_high
+    app.fa_low_high= fa_low_high
+    app.md_low_high= md_low_high
+    app.out_dir= out_dir
+    app.name= name
+    app.template= _STAGED.get('template', template)
+    app.labelMap= _STAGED.get('labelMap', labelMap)
+    app.lut= local.path(lut) if lut else None
+    app.N_proc= fit_nproc
+    app.label2name= _LABEL2NAME or None
+
+    app.main()
+
+    return app.stats
+
 def dwi_quality_wrapper(imgPath, maskPath, bvalFile, bvecFile,
-                        mk_low_high, fa_low_high, md_low_high, out_dir, name, template, labelMap, lut):
+                        mk_low_high, fa_low_high, md_low_high, out_dir, name, template, labelMap, lut, fit_nproc=1):
         
     if bvalFile and bvecFile:
         check_call((' ').join([f'{SCRIPTDIR}/dwi_quality.py',
                 '-i', imgPath,'-m', maskPath, '--bval', bvalFile, '--bvec', bvecFile,
                 '--mk', mk_low_high, '--fa', fa_low_high, '--md', md_low_high,
-                '-o', out_dir, '-n', name, '-t', template, '-l', labelMap, '--lut', lut]), shell= True)
+                '-o', out_dir, '-n', name, '-t', template, '-l', labelMap, '--lut', lut,
+                '--nproc', str(fit_nproc)]), shell= True)
     else:
         check_call((' ').join([f'{SCRIPTDIR}/dwi_quality.py',
                 '-i', imgPath,'-m', maskPath,
                 '--mk', mk_low_high, '--fa', fa_low_high, '--md', md_low_high,
-                '-o', out_dir, '-n', name, '-t', template, '-l', labelMap, '--lut', lut]), shell= True)
+                '-o', out_dir, '-n', name, '-t', template, '-l', labelMap, '--lut', lut,
+                '--nproc', str(fit_nproc)]), shell= True)
+
+def write_summary(results, cases, regions, out_csv):
+    '''Write the statistics of all cases as region x case rows in out_csv,
+    and as a columnar table with one row per (case, region) in a parquet file next to it.
+    results: {case: DataFrame indexed by region}'''
+
+    if not results:
+        raise RuntimeError('dwi_quality failed for all cases, no summary is written')
+
+    index = pd.MultiIndex.from_product([regions, cases], names=['region', 'case'])
+    long= pd.concat(results, names=['case', 'region'])
+    long= long.loc[:, STAT_COLUMNS].apply(pd.to_numeric, errors='coerce').astype(float)
+
+    # same layout as summarize_csvs(): regions, then cases in the order of the image list
+    dfsummary= long.swaplevel().reindex(index).apply(lambda x: x.map(num2str))
+    # failed cases and regions missing from a case are left empty, not nan
+    dfsummary.loc[~index.isin(long.swaplevel().index)]= None
+    dfsummary.to_csv(out_csv)
+    print('See project summary', abspath(out_csv))
+
+    columnar= long.reset_index()
+    parquet= splitext(out_csv)[0]+ '.parquet'
+    try:
+        columnar.to_parquet(parquet, index=False)
+        print('See columnar project summary', abspath(parquet))
+    except ImportError:
+        warnings.warn('pyarrow or fastparquet is required for the parquet summary, only csv summary is written')
+
 
 def summarize_csvs(imgs, labelMapFile, lut, qcDir, labelName, out_csv):
 
@@ -36,17 +128,12 @@ def summarize_csvs(imgs, labelMapFile, lut, qcDir, labelName, out_csv):
         cases.append(basename(imgPath).split('.')[0])
 
     # extract region names from labelMap
-    outLabelMap = nib.load(labelMapFile).get_data()
-    labels = np.unique(outLabelMap)[1:]
-    regions = parse_labels(labels, lut).values()
+    regions = labelmap_regions(labelMapFile, lut).values()
 
     # define dataFrame
     # reference: https://jakevdp.github.io/PythonDataScienceHandbook/03.05-hierarchical-indexing.html
     index = pd.MultiIndex.from_product([regions, cases], names=['region', 'case'])
-    dfsummary= pd.DataFrame(index=index, columns= ['FA_mean', 'FA_std', 'MD_mean', 'MD_std',
-                                                   'AD_mean', 'AD_std', 'RD_mean', 'RD_std',
-                                                   'total_{min_i(b0-Gi)<0}', 'total_evals<0',
-                                                   'MK_mean', 'MK_std'])
+    dfsummary= pd.DataFrame(index=index, columns= STAT_COLUMNS)
 
     # read csvs, append to summary
     for imgPath, case in zip(imgs, cases):
@@ -114,6 +201,14 @@ class quality_batch(cli.Application):
     N_proc = cli.SwitchAttr('--nproc',
             help= 'number of processes/threads to use (-1 for all available, may slow down your system)', default= 4)
 
+    fit_nproc = cli.SwitchAttr('--fit-nproc',
+            help= 'number of processes for DTI/DKI fitting of each case, '
+                  'use fewer cases with more fitting processes to reduce memory usage', default= 1)
+
+    subprocess = cli.Flag('--subprocess',
+            help= 'run each case as a dwi_quality.py subprocess and summarize from the csv files, '
+                  'by default cases run in worker processes that share the parsed labelMap')
+
 
     def main(self):
 
@@ -125,8 +220,21 @@ class quality_batch(cli.Application):
         if int(self.N_proc)==-1:
             self.N_proc= psutil.cpu_count()
 
-        pool= multiprocessing.Pool(int(self.N_proc))
-        for imgPath, maskPath in zip(imgs, masks):
+        lut= self.lut._path if self.lut else None
+        cases= [basename(imgPath).split('.')[0] for imgPath in imgs]
+
+        if self.subprocess:
+            # workers only wait on their dwi_quality.py subprocess
+            pool= ThreadPoolExecutor(int(self.N_proc))
+            func= dwi_quality_wrapper
+        else:
+            label2name= labelmap_regions(self.labelMap, lut)
+            pool= ProcessPoolExecutor(int(self.N_proc), initializer=_init_worker,
+                                      initargs=(self.template, self.labelMap, label2name))
+            func= dwi_quality_case
+
+        jobs= {}
+        for case, imgPath, maskPath in zip(cases, imgs, masks):
             imgPath= imgPath
             inPrefix= imgPath.split('.')[0]
 
@@ -142,16 +250,25 @@ class quality_batch(cli.Application):
                 # force re-run
                 rmtree(out_dir)
             mkdir(out_dir)
-            pool.apply_async(func= dwi_quality_wrapper, args= (imgPath, maskPath, bvalFile, bvecFile,
+            jobs[pool.submit(func, imgPath, maskPath, bvalFile, bvecFile,
                 self.mk_low_high, self.fa_low_high, self.md_low_high, out_dir, self.name,
-                self.template, self.labelMap, self.lut._path if self.lut else None))
-
-
-
-        pool.close()
-        pool.join()
-
-        summarize_csvs(imgs, self.labelMap, self.lut._path if self.lut else None, self.qcDir, self.name, self.out_csv)
+                self.template, self.labelMap, lut, int(self.fit_nproc))]= case
+
+        results= {}
+        with pool:
+            for job in as_completed(jobs):
+                try:
+                    results[jobs[job]]= job.result()
+                except Exception:
+                    print(f'dwi_quality failed for {jobs[job]}')
+                    traceback.print_exc()
+
+        if self.subprocess:
+            summarize_csvs(imgs, self.labelMap, lut, self.qcDir, self.name, self.out_csv)
+        else:
+            # keep the order of the image list, failed cases have empty rows
+            results= {case: results[case] for case in cases if results.get(case) is not None}
+            write_summary(results, cases, list(label2name.values()), self.out_csv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import signal
+
+# arrays attached in each worker of map_volumes(), keyed by the names given by the caller
+_ARRAYS= {}
+
+
+def shared_zeros(shape, dtype='float32'):
+    '''Allocate a zero filled array backed by a SharedMemory block.
+    Returns (shm, array); the caller must shm.close() and shm.unlink() when done.'''
+
+    nbytes= int(np.prod(shape))*np.dtype(dtype).itemsize
+    shm= SharedMemory(create=True, size=max(nbytes,1))
+    arr= np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr[:]= 0
+
+    return shm, arr
+
+
+def release(*shms):
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+def read_volumes(img, out):
+    '''Stream the volumes of a 4D nibabel image into a preallocated array, one volume at a time.
+    For .nii, img.dataobj is memory-mapped; for .nii.gz, volumes are contiguous in the file,
+    so reading them in order decompresses the file only once.'''
+
+    for i in range(out.shape[3]):
+        out[..., i]= img.dataobj[..., i]
+
+    return out
+
+
+def _attach(specs):
+
+    for key, (name, shape, dtype) in specs.items():
+        shm= SharedMemory(name=name)
+        _ARRAYS[key]= (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _run_batch(args):
+
+    func, vols, params= args
+    arrays= {key: arr for key, (_, arr) in _ARRAYS.items()}
+
+    return func(vols, *params, **arrays)
+
+
+def map_volumes(func, arrays, vols, nproc, params=(), batch=1):
+    '''Call func(vols, *params, **arrays) for batches of volume indices on a process pool.
+    vols is the number of volumes or a list of volume indices.
+    arrays is a dictionary of name: (shm, array) obtained from shared_zeros(),
+    each worker attaches them once, so volumes are never pickled through the pool.
+    func must be a module level function.'''
+
+    specs= {key: (shm.name, arr.shape, arr.dtype.str) for key, (shm, arr) in arrays.items()}
+    vols= np.arange(vols) if np.isscalar(vols) else np.array(vols)
+    batches= [(func, b.tolist(), params) for b in
+              np.array_split(vols, max(1, int(np.ceil(len(vols)/batch))))]
+
+    if nproc==1:
+        return [func(b, *params, **{key: arr for key, (_, arr) in arrays.items()})
+                for _, b, _ in batches]
+
+    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool= Pool(nproc, initializer=_attach, initargs=(specs,))
+    signal.signal(signal.SIGINT, sigint_handler)
+    try:
+        res= pool.map(_run_batch, batches)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    return res
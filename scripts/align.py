@@ -4,11 +4,12 @@ from plumbum import cli
 import numpy as np
 from numpy import matrix, diag, linalg, vstack, hstack, array
 
-from util import load_nifti, save_nifti
+from util import load_nifti, save_nifti, write_gzip, n_threads
 
 from conversion.bval_bvec_io import bvec_rotate
 
 import warnings
+import gzip, io, shutil
 
 precision= 17
 
@@ -59,6 +60,28 @@ def update_hdr(hdr_in, spcdir_new, offset_new):
     return hdr_out
 
 
+def write_hdr_only(img_file, hdr_out, out_file, nproc=None):
+    '''Write hdr_out followed by the extensions and voxel block of img_file, byte for byte,
+    so data type and scaling are kept and the voxels are never decoded'''
+
+    opener= gzip.open if img_file.endswith('.gz') else open
+
+    with opener(img_file, 'rb') as fin, open(out_file, 'wb') as fout:
+        # nibabel resets scaling and voxel offset of a loaded header, restore them from the header on disk
+        hdr_in= hdr_out.__class__(fin.read(len(hdr_out.binaryblock)), check=False)
+        hdr_out= hdr_out.copy()
+        for key in ['scl_slope', 'scl_inter', 'vox_offset']:
+            hdr_out[key]= hdr_in[key]
+        hdr_bytes= hdr_out.binaryblock
+
+        if out_file.endswith('.gz'):
+            write_gzip(io.BytesIO(hdr_bytes), fout, nproc)
+            write_gzip(fin, fout, nproc)
+        else:
+            fout.write(hdr_bytes)
+            shutil.copyfileobj(fin, fout, 16*1024**2)
+
+
 class Xalign(cli.Application):
     '''Axis alignment and centering of a 3D/4D NIFTI image'''
 
@@ -98,6 +121,19 @@ class Xalign(cli.Application):
         mandatory=False,
         default= False)
 
+    rewrite = cli.Flag(
+        ['--rewrite'],
+        help='''decode and rewrite the voxel data through save_nifti, which casts to float32 unless uint8/int16;
+        by default, only the header is replaced and the voxel block is copied unchanged''',
+        mandatory=False,
+        default= False)
+
+    nproc = cli.SwitchAttr(
+        ['-n', '--nproc'],
+        help='number of threads for gzip compression of the output',
+        mandatory=False,
+        default= n_threads())
+
 
     def main(self):
 
@@ -178,7 +214,11 @@ class Xalign(cli.Application):
 
 
         # write out the modified image
-        save_nifti(self.out_prefix+'.nii.gz', mri.get_data(), hdr_out.get_best_affine(), hdr_out)
+        if self.rewrite or len(hdr_out.binaryblock)!=hdr['sizeof_hdr']:
+            save_nifti(self.out_prefix+'.nii.gz', load_nifti(self.img_file._path, cache=True).get_data(),
+                       hdr_out.get_best_affine(), hdr_out, int(self.nproc))
+        else:
+            write_hdr_only(self.img_file._path, hdr_out, self.out_prefix+'.nii.gz', int(self.nproc))
 
 
 if __name__ == '__main__':
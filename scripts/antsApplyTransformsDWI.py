@@ -1,29 +1,54 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory
+from util import logfmt, TemporaryDirectory, load_nifti, Nifti1Image, TMP_EXT, write_nifti, compress_nifti
 from plumbum import local, cli, FG
-from plumbum.cmd import WarpImageMultiTransform, fslsplit, fslmaths, fslmerge
+from plumbum.cmd import antsApplyTransforms
+import numpy as np
+from _volume_pool import shared_zeros, read_volumes, map_volumes, release
 
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
-from multiprocessing import Pool
 
+# ITK displacement fields are in LPS, nifti affines are in RAS
+LPS= np.array([[-1.], [-1.], [1.]])
 
-def _WarpImage(dwimask, vol, xfm):
 
-    if dwimask:
-        fslmaths[vol, '-mas', dwimask, vol]
+def warp_coordinates(ref, warp):
+    '''Voxel coordinates in ref where every voxel of ref is sampled after applying an ANTs displacement field.
+    The coordinates are the same for all volumes of a time series.'''
 
-    volwarped = vol.stem + '-warped.nii.gz'
-    WarpImageMultiTransform('3', vol, volwarped, '-R', vol, xfm)
+    ijk= np.indices(ref.shape[:3], dtype='float64').reshape(3, -1)
+    ras= ref.affine[:3, :3] @ ijk + ref.affine[:3, 3:]
+    del ijk
 
-    return volwarped
+    field= np.asanyarray(warp.dataobj).reshape(warp.shape[:3]+(3,))
+    if field.shape[:3]==ref.shape[:3] and np.allclose(warp.affine, ref.affine):
+        disp= field.reshape(-1, 3).T
+    else:
+        # displacement is zero outside the field, same as ITK
+        from scipy.ndimage import map_coordinates
+        inv= np.linalg.inv(warp.affine)
+        wijk= inv[:3, :3] @ ras + inv[:3, 3:]
+        disp= np.stack([map_coordinates(field[..., k], wijk, order=1) for k in range(3)])
+
+    ras+= disp*LPS
+
+    inv= np.linalg.inv(ref.affine)
+    return (inv[:3, :3] @ ras + inv[:3, 3:]).reshape((3,)+ref.shape[:3])
+
+
+def _warp_vols(vols, src, dst, coords):
+    from scipy.ndimage import map_coordinates
+
+    for i in vols:
+        print('Warping volume', i)
+        map_coordinates(src[..., i], coords, output=dst[..., i], order=1)
 
 
 class App(cli.Application):
-    """Applies a transformation to a DWI nrrd, with option of masking first.
-    (Used by epi.py)"""
+    """Applies a transformation to a DWI nifti, with option of masking first.
+    (Used by pnl_epi.py)"""
 
     debug = cli.Flag(
         ['-d', '--debug'], help='debug, makes antsApplyTransformsDWi-<pid>')
@@ -34,45 +59,68 @@ class App(cli.Application):
     xfm = cli.SwitchAttr(['--transform', '-t'], cli.ExistingFile, help='transform', mandatory=True)
     out = cli.SwitchAttr(['-o', '--output'], cli.NonexistentPath, help='transformed DWI')
     nproc = cli.SwitchAttr(
-        ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
+        ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer
         becomes sluggish/you run into memory error, reduce --nproc''', default= 8)
+    engine = cli.SwitchAttr(
+        ['--engine'], cli.Set('scipy', 'ants', case_sensitive=False),
+        help='''scipy: compute the sampling coordinates once and linearly interpolate all volumes in-process,
+        ants: a single antsApplyTransforms -e 3 call over the time series''', default='scipy')
+
+    def _warp(self, img, hdr, shm_src, src, N):
+
+        logging.info("Compute sampling coordinates from the warp")
+        shm_xyz, coords= shared_zeros((3,)+img.shape[:3], 'float64')
+        shm_dst, dst= shared_zeros(img.shape, 'float32')
+        try:
+            coords[:]= warp_coordinates(img, load_nifti(self.xfm._path, cache=True))
+
+            logging.info("Apply warp to each DWI volume")
+            map_volumes(_warp_vols, {'src': (shm_src, src), 'dst': (shm_dst, dst),
+                                     'coords': (shm_xyz, coords)}, N, int(self.nproc))
+
+            write_nifti(Nifti1Image(dst, img.affine, hdr), self.out._path, int(self.nproc))
+        finally:
+            del coords, dst
+            release(shm_xyz, shm_dst)
+
 
     def main(self):
         with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
             tmpdir = local.path(tmpdir)
-            dicePrefix = 'vol'
-
-            logging.info("Dice DWI")
-            fslsplit[self.dwi] & FG
 
-            logging.info("Apply warp to each DWI volume")
-            vols = sorted(tmpdir // (dicePrefix + '*.nii.gz'))
+            img= load_nifti(self.dwi._path, cache=True, mmap='r', keep_file_open=True)
+            N= img.shape[3]
 
-            # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
-            res= []
-            for vol in vols:
-                res.append(pool.apply_async(_WarpImage, (self.dwimask, vol, self.xfm)))
+            hdr= img.header.copy()
+            hdr.set_data_dtype('float32')
 
-            volsWarped= [r.get() for r in res]
-            pool.close()
-            pool.join()
+            shm_src, src= shared_zeros(img.shape, 'float32')
+            try:
+                logging.info("Read DWI")
+                read_volumes(img, src)
 
+                if self.dwimask:
+                    logging.info("Mask DWI")
+                    src*= (load_nifti(self.dwimask._path, cache=True).get_fdata()>0)[..., None]
 
-            # or use the following for loop
-            # volsWarped = []
-            # for vol in vols:
-            #     if self.dwimask:
-            #         fslmaths[vol, '-mas', self.dwimask, vol]
-            #     volwarped = vol.stem + '-warped.nii.gz'
-            #     WarpImageMultiTransform('3', vol, volwarped, '-R', vol, self.xfm)
-            #     volsWarped.append(volwarped)
+                if self.engine.lower()=='ants':
+                    masked= tmpdir / ('dwi_masked'+TMP_EXT)
+                    ref= tmpdir / ('ref'+TMP_EXT)
+                    warped= tmpdir / ('dwi_warped'+TMP_EXT)
+                    Nifti1Image(src, img.affine, hdr).to_filename(masked._path)
+                    Nifti1Image(src[..., 0], img.affine, hdr).to_filename(ref._path)
 
-            logging.info("Join warped volumes together")
+                    logging.info("Apply warp to the DWI time series")
+                    antsApplyTransforms['-d', '3', '-e', '3', '-i', masked, '-r', ref,
+                                        '-t', self.xfm, '-o', warped] & FG
+                    compress_nifti(warped, self.out, int(self.nproc))
 
-            volsWarped.sort()
-            fslmerge['-t', self.out, volsWarped] & FG
+                else:
+                    self._warp(img, hdr, shm_src, src, N)
 
+            finally:
+                del src
+                release(shm_src)
 
             logging.info('Made ' + str(self.out))
 
@@ -1,36 +1,25 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from plumbum import local, cli, FG
-from plumbum.cmd import ComposeMultiTransform, antsApplyTransforms, MeasureImageSimilarity, \
-    head, cut, antsRegistration
 from itertools import zip_longest
-import pandas as pd
 from glob import glob
 import numpy as np
 import sys, os
-import multiprocessing
 from math import exp
-from conversion.antsUtil import antsReg
-from util import logfmt, save_nifti, TemporaryDirectory, load_nifti, N_CPU, N_PROC, dirname, pjoin
+from util import logfmt, save_nifti, TemporaryDirectory, load_nifti, Nifti1Image, N_CPU, N_PROC, dirname, pjoin, \
+    TMP_EXT, compress_nifti, TMPDIR, tool_version, run_threads
+from functools import partial
 
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
 
 
-# determine ANTS_VERSION
-# $ antsRegistration --version
-#   ANTs Version: 2.2.0.dev233-g19285
-#   Compiled: Sep  2 2018 23:23:33
-
-antsVerFile='/tmp/ANTS_VERSION_'+os.environ['USER']
-(antsRegistration['--version'] > antsVerFile) & FG
-with open(antsVerFile) as f:
-      content=f.read().split('\n')
-      ANTS_VERSION= content[0].split()[-1]
-
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO, format=logfmt(__file__))
 
+# warps from training images to a template are computed once and reused for every target
+ATLAS_CACHE= local.path(os.getenv('PNLPIPE_ATLAS_CACHE', TMPDIR / 'pnlpipe-atlas-cache'))
+
 ANTSJOINTFUSION_PARAMS = ['--search-radius', 5
                          ,'--patch-radius',3
                          ,'--patch-metric','PC'
@@ -38,6 +27,20 @@ ANTSJOINTFUSION_PARAMS = ['--search-radius', 5
                          ,'--alpha', 0.4
                          ,'--beta', 3.0]
 
+# pandas, multiprocessing, ANTs commands, and conversion are imported where they are used,
+# so that importing this module in pool workers and batch jobs stays cheap
+
+
+def ants_version():
+    '''ANTs version, e.g. 2.2.0.dev233-g19285 from
+    $ antsRegistration --version
+      ANTs Version: 2.2.0.dev233-g19285
+      Compiled: Sep  2 2018 23:23:33
+    '''
+
+    return tool_version('antsRegistration').split('\n')[0].split()[-1]
+
+
 # with the omission of subcommands, this function is not used anymore
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
@@ -48,24 +51,59 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(fillvalue=fillvalue, *args)
 
 
-def computeWarp(image, target, out):
+def computeWarp(image, target, pre, template=None):
+    '''Registers image to target, returns the transforms in the order expected by antsApplyTransforms:
+    the last transform is applied first'''
 
-    with TemporaryDirectory() as tmpdir:
-        tmpdir = local.path(tmpdir)
-        pre = tmpdir / 'ants'
-        warp = pre + '1Warp.nii.gz'
-        affine = pre + '0GenericAffine.mat'
+    from conversion.antsUtil import antsReg
+
+    if template:
+        # image --> template is read from the cache, template --> target was registered once by makeAtlases()
+        return [template['warp'], template['affine'], *templateWarp(image, template['image'], template['cache'])]
+
+    # pre is the prefix (directory) for saving 1Warp.nii.gz and 0GenericAffine.mat
+    antsReg(target, None, image, pre)
+
+    return [pre + '1Warp.nii.gz', pre + '0GenericAffine.mat']
 
-        # pre is the prefix (directory) for saving 1Warp.nii.gz and 0GenericAffine.mat
-        antsReg(target, None, image, pre)
 
-        # out is Warp{idx}.nii.gz, saved in the specified output direcotry
-        # ComposeMultiTransform combines the 1Warp.nii.gz and 0GenericAffine.mat into a Warp{idx}.nii.gz file
-        ComposeMultiTransform('3', out, '-R', target, warp, affine)
+def templateWarp(image, template, cache=ATLAS_CACHE):
+    '''Registers a training image to template once and keeps the transforms in cache.
+    Entries are keyed by path, mtime, and size of both images and the ANTs version,
+    so a modified image or template is registered again.
+    Returns (warp, affine) in the order expected by antsApplyTransforms'''
 
+    import hashlib
+    from conversion.antsUtil import antsReg
 
+    key= [ants_version()]
+    for f in (image, template):
+        stat= os.stat(f)
+        key.append(f'{os.path.abspath(f)}:{stat.st_mtime_ns}:{stat.st_size}')
+    entry= cache / hashlib.md5(','.join(key).encode()).hexdigest()
+    warp= entry / 'ants1Warp.nii.gz'
+    affine= entry / 'ants0GenericAffine.mat'
 
-def applyWarp(moving, warp, reference, out, interpolation='Linear'):
+    if not warp.exists():
+        cache.mkdir()
+        logging.info('Registering {} to template, saving transforms in {}'.format(image, entry))
+        # register in a private directory and rename, so concurrent cases never read partial transforms
+        with TemporaryDirectory(dir=cache) as tmpdir:
+            antsReg(template, None, image, pjoin(tmpdir, 'ants'))
+            # mkdtemp makes the directory 0700, let other users of a shared cache read the entry
+            umask= os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpdir, 0o777 & ~umask)
+            try:
+                os.rename(tmpdir, entry)
+            except OSError:
+                # made by another process meanwhile
+                pass
+
+    return warp, affine
+
+
+def applyWarp(moving, transforms, reference, out, interpolation='Linear', imagetype=0):
     '''Interpolation options:
     Linear
     NearestNeighbor
@@ -77,21 +115,71 @@ def applyWarp(moving, warp, reference, out, interpolation='Linear'):
     HammingWindowedSinc
     LanczosWindowedSinc
     GenericLabel[<interpolator=Linear>]
+    imagetype 3 applies the 3D transforms to each volume of a 4D moving image
     '''
 
-    # antsApplyTransforms reads Warp{idx}.nii.gz and 
+    from plumbum.cmd import antsApplyTransforms
+
+    # antsApplyTransforms reads the transform chain of atlas{idx} and
     # creates atlas{idx}.nii.gz and {labelname}{idx}.nii.gz in the specified ouput directory
-    antsApplyTransforms['-d', '3', '-i', moving, '-t', warp, '-r', reference,
+    xfms= []
+    for t in transforms:
+        xfms+= ['-t', t]
+    antsApplyTransforms['-d', '3', '-e', imagetype, '-i', moving, *xfms, '-r', reference,
                         '-o', out, '--interpolation', interpolation] & FG
 
 
-def computeMI(target, img, miFile):
+def applyWarpLabels(labels, transforms, reference, outs, tmpdir):
+    '''Resamples labelmaps of one atlas in a single antsApplyTransforms call:
+    labelmaps on the same grid are stacked into a 4D image, warped volume-wise, and split into outs'''
 
-    if ANTS_VERSION <= '2.1.0':
-        (MeasureImageSimilarity['3', '2', target, img] | head['-n', '-2'] | cut['-d ', '-f6'] > miFile)()
+    imgs= [load_nifti(str(label), cache=True) for label in labels]
+    if len(imgs)==1 or any(img.shape!=imgs[0].shape or not np.allclose(img.affine, imgs[0].affine)
+                           for img in imgs):
+        for label, out in zip(labels, outs):
+            applyWarp(label, transforms, reference, out, interpolation='NearestNeighbor')
+        return
 
-    else:
-        (MeasureImageSimilarity['-d', '3', '-m', 'MI[{},{},1,256]'.format(target, img)] > miFile) & FG
+    stack= tmpdir / ('labels'+TMP_EXT)
+    warped= tmpdir / ('labelsWarped'+TMP_EXT)
+    data= np.stack([np.asanyarray(img.dataobj) for img in imgs], axis=-1)
+    hdr= imgs[0].header.copy()
+    hdr.set_data_dtype(data.dtype)
+    Nifti1Image(data, imgs[0].affine, hdr).to_filename(stack._path)
+
+    applyWarp(stack, transforms, reference, warped, interpolation='NearestNeighbor', imagetype=3)
+
+    warped= load_nifti(warped._path)
+    for i, out in enumerate(outs):
+        warped.slicer[..., i].to_filename(str(out))
+
+
+def quantize(data, bins):
+
+    lo, hi= data.min(), data.max()
+    levels= (data-lo)*(bins/(hi-lo)) if hi>lo else np.zeros(data.shape)
+
+    return np.minimum(levels.astype(np.int64), bins-1).ravel()
+
+
+def computeMI(target, images, bins=256):
+    '''Mutual information between target and each of images from joint histograms of bins intensity levels.
+    Values are negated like the ANTs MI metric, the most similar image has the lowest value.'''
+
+    t= quantize(load_nifti(target._path, cache=True).get_fdata(dtype='float32'), bins)
+    pt= np.bincount(t, minlength=bins)/len(t)
+
+    mis= []
+    for img in images:
+        print('MI between {} and target'.format(img))
+        i= quantize(load_nifti(img._path).get_fdata(dtype='float32'), bins)
+        joint= np.bincount(t*bins+i, minlength=bins*bins).reshape(bins, bins)/len(t)
+        pi= joint.sum(0)
+
+        nz= joint>0
+        mis.append(-(joint[nz]*np.log(joint[nz]/np.outer(pt, pi)[nz])).sum())
+
+    return mis
 
 
 def weightsFromMIExp(mis, alpha):
@@ -99,19 +187,23 @@ def weightsFromMIExp(mis, alpha):
     weights = [exp(factor * (min(mis) - mi)) for mi in mis]
     return [w / sum(weights) for w in weights]
 
-def fuseWeightedAvg(labels, weights, out, target_header):
+def fuseWeightedAvg(labelmaps, weights, outs, target_header):
+    '''Fuse all labelmap columns in one pass over the atlases:
+    labelmaps[labelname][i] of atlas i is weighted by weights[i] and added to the float32 buffer of labelname,
+    buffers are thresholded at 0.5 and saved as outs[labelname]'''
 
-    # for each label, fuse warped labelmaps to compute output labelmap
-    print("Apply weights to warped training {} et al., fuse, and threshold".format(labels[0]))
-    data= np.zeros(target_header['dim'][1:4], dtype= 'float32')
-    for label, w in zip(labels, weights):
-        data+= load_nifti(label._path).get_data()*w
+    data= {labelname: np.zeros(target_header['dim'][1:4], dtype= 'float32') for labelname in labelmaps}
+    for i, w in enumerate(weights):
+        for labelname in labelmaps:
+            # uncompressed labelmaps are memory-mapped
+            data[labelname]+= np.float32(w)*np.asanyarray(load_nifti(labelmaps[labelname][i]._path).dataobj)
 
+    for labelname in labelmaps:
+        # out is {labelname}.nii.gz
+        save_nifti(outs[labelname], ((data[labelname]>0.5)*1).astype('uint8'),
+                   target_header.get_best_affine(), target_header)
 
-    # out is {labelname}.nii.gz
-    save_nifti(out, ((data>0.5)*1).astype('uint8'), target_header.get_best_affine(), target_header)
-
-    print("Made labelmap: " + out)
+        print("Made labelmap: " + outs[labelname])
 
 
 def fuseAntsJointFusion(target, images, labels, out):
@@ -120,152 +212,173 @@ def fuseAntsJointFusion(target, images, labels, out):
     # images are the warped images atlas{idx}.nii.gz
     # labelmaps are the warped labels {labelname}{idx}.nii.gz
     # out is {labelname}.nii.gz
-    antsJointFusionArgs = \
-        ['-d', 3 ,'-t', target ,'-g'] + \
-        images + \
-        ['-l'] +  \
-        labels + \
-        ['-o', out] + \
-        ['--verbose']
-
-    antsJointFusion[antsJointFusionArgs] & FG
+    with TemporaryDirectory() as tmpdir:
+        fused = local.path(tmpdir) / ('fused'+TMP_EXT)
+        antsJointFusionArgs = \
+            ['-d', 3 ,'-t', target ,'-g'] + \
+            images + \
+            ['-l'] +  \
+            labels + \
+            ['-o', fused] + \
+            ['--verbose']
+
+        antsJointFusion[antsJointFusionArgs] & FG
+        compress_nifti(fused, out)
 
     print("Made labelmap: " + out)
 
 
-def fuseAvg(labels, out, target_header):
-    from plumbum.cmd import AverageImages
+def similarity(target, image, shrink=4):
+    '''Normalized cross correlation between target and image sampled on every shrink-th voxel of target,
+    image is aligned to target by the centers of mass of both in physical space'''
 
-    with TemporaryDirectory() as tmpdir:
-        nii = local.path(tmpdir) / 'avg.nii.gz'
-        AverageImages['3', nii, '0', labels] & FG
+    from scipy.ndimage import map_coordinates, center_of_mass
 
-        img= load_nifti(nii._path)
-        # Binary operation, if out>0.5, pipe the output and save as {labelname}.nii.gz
-        # out is {labelname}.nii.gz
-        save_nifti(out, ((img.get_data()>0.5)*1).astype('uint8'), target_header.get_best_affine(), target_header)
+    target= load_nifti(str(target), cache=True)
+    tdata= target.get_fdata()[::shrink, ::shrink, ::shrink]
+    taffine= target.affine.copy()
+    taffine[:3, :3]*= shrink
 
+    img= load_nifti(str(image), cache=True)
+    data= img.get_fdata()
 
-    print("Made labelmap: " + out)
+    shift= img.affine[:3, :3] @ center_of_mass(data) + img.affine[:3, 3] \
+        - (taffine[:3, :3] @ center_of_mass(tdata) + taffine[:3, 3])
+
+    # voxel coordinates in image of the downsampled target grid
+    ijk= np.indices(tdata.shape).reshape(3, -1)
+    ras= taffine[:3, :3] @ ijk + (taffine[:3, 3] + shift)[:, None]
+    inv= np.linalg.inv(img.affine)
+    moved= map_coordinates(data, inv[:3, :3] @ ras + inv[:3, 3:], order=1)
+
+    return np.corrcoef(tdata.ravel(), moved)[0, 1]
+
+
+def selectAtlases(target, trainingTable, k, threads, log):
+    '''Keeps the k training rows whose images are most similar to target, scores are written to log'''
+
+    import pandas as pd
+    import multiprocessing
+
+    pool = multiprocessing.Pool(threads)
+    scores= pool.map(partial(similarity, target), trainingTable.iloc[:, 0])
+    pool.close()
+    pool.join()
 
+    # corrcoef is nan when the moved image is constant e.g. it does not overlap target, such atlases rank last
+    order= np.argsort(np.nan_to_num(scores, nan=-np.inf))[::-1]
+    selected= np.zeros(len(scores), dtype=bool)
+    selected[order[:k]]= True
 
-def train2target(itr):
+    pd.DataFrame({'image': trainingTable.iloc[:, 0], 'score': scores, 'selected': selected}).to_csv(log, index=False)
+    logging.info('Selected {} of {} atlases, scores are in {}'.format(k, len(scores), log))
+
+    return trainingTable.iloc[np.sort(order[:k])].reset_index(drop=True)
+
+
+def train2target(itr, template=None, debug=False):
 
     idx, attr = itr
     outdir, target= attr[-2: ]
     r= attr[:-2]
 
     print('Registering image {} to target'.format(idx))
-    warp = outdir / 'warp{}.nii.gz'.format(idx)
-    atlas = outdir / 'atlas{}.nii.gz'.format(idx)
+    xfmdir = outdir / 'xfm{}'.format(idx)
+    xfmdir.mkdir()
+    atlas = outdir / 'atlas{}{}'.format(idx, TMP_EXT)
     logging.info('Making {}'.format(atlas))
 
     # warp is computed among the first column images and the target image
     # then that warp is applied to images in other columns
     # assuming first column of the dictionary contains moving images
-    computeWarp(r[0], target, warp)  # first column of each row is used here
-    applyWarp(r[0], warp, target, atlas)  # first column of each row is used here
-
-    # labelname is the column header and label is the image in the csv file
-    for labelname, label in r.iloc[1:].iteritems():  # rest of the columns of each row are used here
-        atlaslabel = outdir / '{}{}.nii.gz'.format(labelname,idx)
-        logging.info('Making {}'.format(atlaslabel))
+    transforms= computeWarp(r[0], target, xfmdir / 'ants', template)  # first column of each row is used here
+    applyWarp(r[0], transforms, target, atlas)  # first column of each row is used here
 
-        # creates {labelname}{idx}.nii.gz in the output directory
-        # applying Warp{idx}.nii.gz on each image under 'labelname' column in the csv file
+    if debug:
+        from plumbum.cmd import ComposeMultiTransform
+        # warp{idx} combines the transform chain into one displacement field for inspection
+        ComposeMultiTransform('3', outdir / 'warp{}{}'.format(idx, TMP_EXT), '-R', target, *transforms)
 
+    # labelname is the column header and label is the image in the csv file
+    # creates {labelname}{idx}.nii.gz in the output directory
+    # applying the transforms on each image under 'labelname' column in the csv file
+    labelnames= r.index[1:]  # rest of the columns of each row are used here
+    atlaslabels= [outdir / '{}{}{}'.format(labelname,idx,TMP_EXT) for labelname in labelnames]
+    logging.info('Making {}'.format(', '.join(str(a) for a in atlaslabels)))
+    applyWarpLabels(r.iloc[1:].tolist(), transforms, target, atlaslabels, xfmdir)
 
-        applyWarp(label,
-                  warp,
-                  target,
-                  atlaslabel,
-                  interpolation='NearestNeighbor')
 
+def makeAtlases(target, trainingTable, outPrefix, fusion, threads, debug, template=None, cache=ATLAS_CACHE, select=0):
 
-def makeAtlases(target, trainingTable, outPrefix, fusion, threads, debug):
+    import pandas as pd
+    from conversion.antsUtil import antsReg
 
     with TemporaryDirectory() as tmpdir:
 
         tmpdir = local.path(tmpdir)
 
+        if 0<select<len(trainingTable):
+            logging.info('Score training images against target to select atlases')
+            trainingTable= selectAtlases(target, trainingTable, select, threads, tmpdir / 'selection.csv')
+
         L= len(trainingTable)
 
         multiDataFrame= pd.concat([trainingTable, pd.DataFrame({'tmpdir': [tmpdir]*L, 'target': [str(target)]*L})], axis= 1)
 
-        logging.info('Create {} atlases: compute transforms from images to target and apply over images'.format(L))
-
-        pool = multiprocessing.Pool(threads)  # Use all available cores, otherwise specify the number you want as an argument
+        if template:
+            logging.info('Register template to target')
+            pre = tmpdir / 'template'
+            antsReg(target, None, template, pre)
+            template= {'image': str(template), 'cache': local.path(cache),
+                       'warp': pre + '1Warp.nii.gz', 'affine': pre + '0GenericAffine.mat'}
 
-        pool.map_async(train2target, multiDataFrame.iterrows())
+        logging.info('Create {} atlases: compute transforms from images to target and apply over images'.format(L))
 
-        pool.close()
-        pool.join()
+        # registrations run on threads, the first failure stops the remaining ones
+        run_threads(partial(train2target, template=template, debug=debug), list(multiDataFrame.iterrows()), threads)
 
         logging.info('Fuse warped labelmaps to compute output labelmaps')
-        atlasimages = tmpdir // 'atlas*.nii.gz'
+        atlasimages = tmpdir // ('atlas*'+TMP_EXT)
         # sorting is required for applying weight to corresponding labelmap
         atlasimages.sort()
 
+        target_header= load_nifti(target._path).header
+        labelmaps= {}
+        outs= {}
+        for labelname in list(trainingTable)[1:]:  # list(d) gets column names
+
+            out = os.path.abspath(outPrefix+ f'_{labelname}.nii.gz')
+            if os.path.exists(out):
+                os.remove(out)
+            outs[labelname]= out
+            labelmaps[labelname] = tmpdir // (labelname + '*')
+            labelmaps[labelname].sort()
+
         if fusion.lower() == 'wavg':
 
             ALPHA_DEFAULT= 0.45
 
             logging.info('Compute MI between warped images and target')
-            pool = multiprocessing.Pool(threads)
-            for img in atlasimages:
-                print('MI between {} and target'.format(img))
-                miFile= img+'.txt'
-                pool.apply_async(func= computeMI, args= (target, img, miFile, ))
-
-            pool.close()
-            pool.join()
-
-            mis= []
+            mis= computeMI(target, atlasimages)
             with open(tmpdir+'/MI.txt','w') as fw:
-
-                for img in atlasimages:
-                    with open(img+'.txt') as f:
-                        mi= f.read().strip()
-                        fw.write(img+','+mi+'\n')
-                        mis.append(float(mi))
+                for img, mi in zip(atlasimages, mis):
+                    fw.write(img+','+str(mi)+'\n')
 
             weights = weightsFromMIExp(mis, ALPHA_DEFAULT)
+            fuseWeightedAvg(labelmaps, weights, outs, target_header)
 
-        target_header= load_nifti(target._path).header
-        pool = multiprocessing.Pool(threads)  # Use all available cores, otherwise specify the number you want as an argument
-        for labelname in list(trainingTable)[1:]:  # list(d) gets column names
+        elif fusion.lower() == 'avg':
+            fuseWeightedAvg(labelmaps, [1/len(atlasimages)]*len(atlasimages), outs, target_header)
 
-            out = os.path.abspath(outPrefix+ f'_{labelname}.nii.gz')
-            if os.path.exists(out):
-                os.remove(out)
-            labelmaps = tmpdir // (labelname + '*')
-            labelmaps.sort()
-
-            if fusion.lower() == 'avg':
-                print(' ')
-                # parellelize
-                # fuseAvg(labelmaps, out, target_header)
-                pool.apply_async(func= fuseAvg, args= (labelmaps, out, target_header, ))
-
-            elif fusion.lower() == 'antsjointfusion':
-                print(' ')
-                # atlasimages are the warped images
-                # labelmaps are the warped labels
-                # parellelize
-                # fuseAntsJointFusion(target, atlasimages, labelmaps, out)
-                pool.apply_async(func= fuseAntsJointFusion, args= (target, atlasimages, labelmaps, out, ))
-
-            elif fusion.lower() == 'wavg':
-                print(' ')
-                # parellelize
-                # fuseWeightedAvg(labelmaps, weights, out, target_header)
-                pool.apply_async(func= fuseWeightedAvg, args= (labelmaps, weights, out, target_header, ))
-
-            else:
-                print('Unrecognized fusion option: {}. Skipping.'.format(fusion))
-
-        pool.close()
-        pool.join()
+        elif fusion.lower() == 'antsjointfusion':
+            # atlasimages are the warped images
+            # labelmaps are the warped labels
+            # one antsJointFusion for each labelname, run on threads
+            run_threads(lambda labelname: fuseAntsJointFusion(target, atlasimages, labelmaps[labelname], outs[labelname]),
+                        labelmaps, threads)
+
+        else:
+            print('Unrecognized fusion option: {}. Skipping.'.format(fusion))
 
         if debug:
             tmpdir.copy(pjoin(dirname(outPrefix), 'atlas-debug-' + str(os.getpid())))
@@ -314,6 +427,16 @@ class AtlasCsv(cli.Application):
         help='number of processes/threads to use (-1 for all available)',
         default= N_PROC)
     debug = cli.Flag('-d', help='Debug mode, saves intermediate labelmaps to atlas-debug-<pid> in output directory')
+    template = cli.SwitchAttr(['--template'], cli.ExistingFile,
+        help='study template: training images are registered to it once and the transforms are cached, '
+             'so only the template is registered to each target')
+    cache = cli.SwitchAttr(['--template-cache'],
+        help='directory of cached training image to template transforms, '
+             'default: $PNLPIPE_ATLAS_CACHE or $PNLPIPE_TMPDIR/pnlpipe-atlas-cache', default=ATLAS_CACHE)
+    select = cli.SwitchAttr(['--select'], int,
+        help='register only the given number of training images most similar to the target, '
+             'similarity is the correlation after aligning centers of mass, '
+             'scores are saved in selection.csv of the debug directory (0 for all)', default=0)
     csvFile = cli.SwitchAttr(['--train'],
         help='--train t1; --train t2; --train trainingImages.csv; '
         'see pnlNipype/docs/TUTORIAL.md to know what each value means')
@@ -331,8 +454,10 @@ class AtlasCsv(cli.Application):
         elif self.csvFile=='t2':
             self.csvFile=glob(PNLPIPE_SOFT+'/trainingDataT2Masks-*/trainingDataT2Masks-hdr.csv')[0]
         
+        import pandas as pd
         trainingTable = pd.read_csv(self.csvFile)
-        makeAtlases(self.target, trainingTable, self.out, self.fusions, int(self.threads), self.debug)
+        makeAtlases(self.target, trainingTable, self.out, self.fusions, int(self.threads), self.debug,
+                    self.template, self.cache, self.select)
         logging.info('Made ' + self.out + '_*.nii.gz')
 
 
@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 
-from plumbum.cmd import bet, fslroi
+from plumbum.cmd import bet
 from plumbum import cli, FG, local
 import os
-import numpy as np
-from conversion import read_bvals
+from bse import extract_b0
 from util import BET_THRESHOLD, B0_THRESHOLD, load_nifti
 
 
@@ -14,17 +13,9 @@ def bet_mask(imgPath, maskPath, dim, bvalFile= None, thr= BET_THRESHOLD):
         bsetmp = tmpdir / 'bse.nii.gz'
 
         if dim==4:
-            bvals = read_bvals(bvalFile)
-            idx = np.where([bval < B0_THRESHOLD for bval in bvals])[0]
+            extract_b0(imgPath, bvalFile, bsetmp, threshold=B0_THRESHOLD)
 
-
-            if len(idx) >= 1:
-                fslroi[imgPath, bsetmp, idx, 1] & FG
-
-                bet[bsetmp, maskPath, '-m', '-n', '-f', thr] & FG
-
-            else:
-                raise Exception('No b0 image found. Check the bval file.')
+            bet[bsetmp, maskPath, '-m', '-n', '-f', thr] & FG
 
 
         elif dim==3:
@@ -1,13 +1,64 @@
 #!/usr/bin/env python
 
-from plumbum import cli, FG
-from plumbum.cmd import fslroi, ImageMath
+from plumbum import cli
 from conversion import read_bvals
 import os
-from util import load_nifti, save_nifti, B0_THRESHOLD
+from util import load_nifti, B0_THRESHOLD, Nifti1Image
 
 import numpy as np
 
+B0_MODES= ['first', 'min', 'avg', 'all']
+
+
+def extract_b0(dwi, bvals, out=None, mode='first', mask=None, threshold=B0_THRESHOLD):
+    '''Extract the baseline image from a nifti DWI, reading only the chosen volumes.
+    bvals is a bval file or a list of bvalues
+    mode: first b0, min bvalue volume, avg of b0s, or all b0s stacked along the last axis
+    mask: if provided, the baseline image is masked
+    Returns the baseline Nifti1Image, also saved as out if provided.'''
+
+    if mode not in B0_MODES:
+        raise ValueError(f'Invalid mode {mode}, choose one of {B0_MODES}')
+
+    if isinstance(bvals, (str, os.PathLike)):
+        bvals= read_bvals(str(bvals))
+    bvals= np.array(bvals, dtype=float)
+
+    idx= np.where(bvals < float(threshold))[0]
+    if len(idx)<1:
+        raise Exception('No b0 image found. Check the bval file.')
+
+    if mode=='first':
+        vols= idx[:1]
+    elif mode=='min':
+        vols= np.argsort(bvals)[:1]
+    else:
+        vols= idx
+
+    img= load_nifti(str(dwi), cache=True, keep_file_open=True)
+    hdr= img.header.copy()
+
+    # volumes are read in order, so a .nii.gz is decompressed at most once
+    data= np.stack([np.asanyarray(img.dataobj[..., i]) for i in vols], axis=-1)
+    if mode=='avg':
+        data= data.mean(axis=-1)
+    elif data.shape[-1]==1:
+        data= data[..., 0]
+
+    if mask:
+        # a boolean mask keeps the data type of the baseline image
+        mask= np.asanyarray(load_nifti(str(mask), cache=True).dataobj)>0
+        data= data*(mask[..., None] if data.ndim==4 else mask)
+
+    # same as fslroi, extracted volumes keep the data type of the DWI
+    b0= Nifti1Image(data, img.affine, hdr)
+    b0.set_data_dtype('float32' if mode=='avg' else img.get_data_dtype())
+    if out:
+        b0.to_filename(str(out))
+
+    return b0
+
+
 class App(cli.Application):
     """Extracts the baseline (b0) from a nifti DWI. Assumes
     the diffusion volumes are indexed by the last axis. Chooses the first b0 as the
@@ -75,45 +126,22 @@ class App(cli.Application):
             if not self.bval_file:
                 self.bval_file= os.path.join(directory, prefix+'.bval')
 
-            bvals= read_bvals(self.bval_file)
-            idx= np.where([bval < self.b0_threshold for bval in bvals])[0]
-
-
-            if len(idx)>=1:
-
-                # default is the first b0
-                if not (self.minimum or self.average or self.all):
-                    fslroi[self.dwi, self.out, idx, 1] & FG
-
-                elif self.minimum:
-                    fslroi[self.dwi, self.out, idx, np.argsort(bvals)[0]] & FG
-
-                elif self.average:
-                    # Load the given dwi to get image data
-                    dwi= load_nifti(self.dwi._path)
-                    hdr= dwi.header
-                    mri= dwi.get_data()
-
-                    avg_bse= np.mean(mri[:,:,:,idx], axis= 3)
-
-                    # Now write back the average bse
-                    save_nifti(self.out, avg_bse, dwi.affine, hdr)
-
-
-                elif self.all:
-                    fslroi[self.dwi, self.out, idx, len(idx)] & FG
-
-
+            if self.minimum:
+                mode= 'min'
+            elif self.average:
+                mode= 'avg'
+            elif self.all:
+                mode= 'all'
+            # default is the first b0
             else:
-                raise Exception('No b0 image found. Check the bval file.')
+                mode= 'first'
+
+            extract_b0(self.dwi._path, self.bval_file, self.out, mode, self.dwimask, self.b0_threshold)
 
 
         else:
             raise Exception("Invalid dwi format, must be a nifti image")
 
-        if self.dwimask:
-            ImageMath(3, self.out, 'm', self.out, self.dwimask)
-
 
 if __name__ == '__main__':
     App.run()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+from plumbum import cli
+import numpy as np
+import itertools, tarfile
+from pathlib import Path
+from conversion import read_bvecs, write_bvecs
+
+
+def read_affines(files):
+    '''Stack 4x4 text matrices, e.g. flirt -omat outputs, into an (N,4,4) array with one parse'''
+
+    lines= itertools.chain.from_iterable(Path(f).read_text().splitlines() for f in files)
+    return np.loadtxt(lines).reshape(-1, 4, 4)
+
+
+def read_affines_tgz(tgz):
+    '''(N,4,4) affines of the .txt matrices in a tar archive, e.g. <out>_xfms.tgz of pnl_eddy.py,
+    ordered by name'''
+
+    with tarfile.open(tgz) as tar:
+        members= sorted((m for m in tar.getmembers() if m.name.endswith('.txt')), key=lambda m: m.name)
+        lines= itertools.chain.from_iterable(tar.extractfile(m).read().decode().splitlines() for m in members)
+        return np.loadtxt(lines).reshape(-1, 4, 4)
+
+
+def polar_rotations(affines):
+    '''Rotations of the polar decomposition A = R S of the linear part of (N,3,3) or (N,4,4) affines,
+    R = U V' from the SVD A = U s V', same as (A A')^(-1/2) A'''
+
+    U, _, Vt= np.linalg.svd(np.asarray(affines)[:, :3, :3])
+    return U @ Vt
+
+
+def rotate_bvecs(bvecs, rotations):
+    '''Rotate (N,3) bvecs by (N,3,3) rotations, one rotation for each gradient'''
+
+    return np.einsum('nij,nj->ni', rotations, np.asarray(bvecs, dtype=float))
+
+
+class App(cli.Application):
+    '''Rotate bvecs by the rotations of per-volume registration matrices,
+    e.g. to redo the gradient reorientation of pnl_eddy.py from its saved transforms'''
+
+    bvecFile = cli.SwitchAttr('--bvecs', cli.ExistingFile, help='bvec file', mandatory=True)
+    xfms = cli.SwitchAttr('--xfms', help='''<out>_xfms.tgz of pnl_eddy.py or comma separated 4x4 matrices,
+        one for each gradient in the order of bvecs''', mandatory=True)
+    out = cli.SwitchAttr('-o', help='rotated bvec file', mandatory=True)
+
+    def main(self):
+
+        if self.xfms.endswith('.tgz'):
+            affines= read_affines_tgz(self.xfms)
+        else:
+            affines= read_affines(self.xfms.split(','))
+
+        bvecs= read_bvecs(self.bvecFile._path)
+        if len(bvecs)!=len(affines):
+            raise ValueError(f'{len(bvecs)} bvecs but {len(affines)} transforms')
+
+        write_bvecs(self.out, rotate_bvecs(bvecs, polar_rotations(affines)).tolist())
+
+
+if __name__ == '__main__':
+    App.run()
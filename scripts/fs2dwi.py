@@ -6,6 +6,7 @@ from plumbum.cmd import ResampleImageBySpacing, antsApplyTransforms, ImageMath
 from subprocess import check_call
 
 from util import load_nifti, FILEDIR, pjoin
+from bse import extract_b0
 
 
 def rigid_registration(dim, moving, fixed, outPrefix):
@@ -157,8 +158,8 @@ class Direct(cli.Application):
 
             if not self.parent.bse:
                 print('Extracting B0 from DWI and masking it')
-                check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-i', self.parent.dwi, '--bvals', self.parent.bvals_file,
-                                       '-m', self.parent.dwimask, '-o', b0masked]), shell= True)
+                extract_b0(self.parent.dwi._path, self.parent.bvals_file._path, b0masked._path,
+                           mask=self.parent.dwimask._path)
                 print('Made masked B0')
             else:
                 self.parent.bse.copy(b0masked)
@@ -252,8 +253,8 @@ class WithT2(cli.Application):
 
             if not self.parent.bse:
                 print('Extracting B0 from DWI and masking it')
-                check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-i', self.parent.dwi, '--bvals', self.parent.bvals_file,
-                                       '-m', self.parent.dwimask, '-o', b0masked]), shell= True)
+                extract_b0(self.parent.dwi._path, self.parent.bvals_file._path, b0masked._path,
+                           mask=self.parent.dwimask._path)
                 print('Made masked B0')
             else:
                 self.parent.bse.copy(b0masked)
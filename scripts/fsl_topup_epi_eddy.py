@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 
 from maskfilter import single_scale
+from bse import extract_b0
 from plumbum import cli, FG, local
 from plumbum.cmd import topup, applytopup, fslmaths, rm, fslmerge, cat, bet, gzip, rm
-from util import BET_THRESHOLD, logfmt, load_nifti, FILEDIR, \
-    REPOL_BSHELL_GREATER, save_nifti, B0_THRESHOLD
+from util import BET_THRESHOLD, logfmt, load_nifti, \
+    REPOL_BSHELL_GREATER, save_nifti, B0_THRESHOLD, TMP_EXT, fsl_tmp_env, compress_nifti
 from tempfile import TemporaryDirectory
 from os.path import join as pjoin, abspath, basename
-from subprocess import check_call
-from os import environ
-from shutil import copyfile, move
+from os import environ, remove
+from shutil import copyfile
+from glob import glob
 from conversion import read_bvals, read_bvecs, write_bvals, write_bvecs
 from _eddy_config import obtain_fsl_eddy_params
 import numpy as np
@@ -25,9 +26,9 @@ logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
 def obtainB0(inVol, bvalFile, outVol, num_b0):
 
     if num_b0 == '1':
-        check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', inVol, '--bvals', bvalFile, '-o', outVol]), shell=True)
+        extract_b0(inVol, bvalFile, outVol)
     elif num_b0 == '-1':
-        check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', inVol, '--bvals', bvalFile, '-o', outVol, '--all']), shell=True)
+        extract_b0(inVol, bvalFile, outVol, 'all')
     else:
         raise ValueError('Invalid --numb0')
 
@@ -176,7 +177,7 @@ class TopupEddyEpi(cli.Application):
 
             # free space, see https://github.com/pnlbwh/pnlNipype/issues/82
             if '--repol' in eddy_openmp_params:
-                rm[f'{outPrefix}.eddy_outlier_free_data.nii.gz'] & FG
+                rm[f'{outPrefix}.eddy_outlier_free_data{TMP_EXT}'] & FG
                     
             bvals = np.array(read_bvals(modBvals))
             ind= [i for i in range(len(bvals)) if bvals[i]>B0_THRESHOLD and bvals[i]<= REPOL_BSHELL_GREATER]
@@ -212,12 +213,12 @@ class TopupEddyEpi(cli.Application):
                 merged_bvecs = repol_bvecs.copy()
                 merged_bvecs[ind, :] = wo_repol_bvecs[ind, :]
 
-                repol_data = load_nifti(outPrefix + '.nii.gz')
-                wo_repol_data = load_nifti(wo_repol_outPrefix + '.nii.gz')
+                repol_data = load_nifti(outPrefix + TMP_EXT)
+                wo_repol_data = load_nifti(wo_repol_outPrefix + TMP_EXT)
                 merged_data = repol_data.get_fdata().copy()
                 merged_data[..., ind] = wo_repol_data.get_fdata()[..., ind]
 
-                save_nifti(outPrefix + '.nii.gz', merged_data, repol_data.affine, hdr=repol_data.header)
+                save_nifti(outPrefix + TMP_EXT, merged_data, repol_data.affine, hdr=repol_data.header)
 
                 # copy bval,bvec to have same prefix as that of eddy corrected volume
                 write_bvecs(outPrefix + '.bvec', merged_bvecs)
@@ -295,13 +296,14 @@ class TopupEddyEpi(cli.Application):
 
 
 
-        with local.cwd(self.outDir):
+        # FSL writes uncompressed files in outDir, all of them are compressed at the end
+        with local.cwd(self.outDir), fsl_tmp_env():
 
             # mask both volumes, fslmaths can do that irrespective of dimension
             logging.info('Masking the volumes')
 
-            primaryMaskedVol = 'primary_masked.nii.gz'
-            secondaryMaskedVol = 'secondary_masked.nii.gz'
+            primaryMaskedVol = 'primary_masked'+TMP_EXT
+            secondaryMaskedVol = 'secondary_masked'+TMP_EXT
 
             if primaryMask:
                 # mask the volume
@@ -317,8 +319,8 @@ class TopupEddyEpi(cli.Application):
 
 
             logging.info('Extracting B0 from masked volumes')
-            B0_PA= 'B0_PA.nii.gz'
-            B0_AP= 'B0_AP.nii.gz'
+            B0_PA= 'B0_PA'+TMP_EXT
+            B0_AP= 'B0_AP'+TMP_EXT
 
             obtainB0(primaryMaskedVol, primaryBval, B0_PA, self.num_b0)
 
@@ -328,7 +330,7 @@ class TopupEddyEpi(cli.Application):
                 B0_AP= secondaryMaskedVol
 
 
-            B0_PA_AP_merged = 'B0_PA_AP_merged.nii.gz'
+            B0_PA_AP_merged = 'B0_PA_AP_merged'+TMP_EXT
             with open(self.acqparams_file._path) as f:
                 acqp= f.read().strip().split('\n')
                 if len(acqp)!=2:
@@ -367,7 +369,7 @@ class TopupEddyEpi(cli.Application):
 
             logging.info('Running topup')
             topup_results= 'topup_out'
-            topupOut= 'topup_out.nii.gz'
+            topupOut= 'topup_out'+TMP_EXT
             
             # topup --iout yields as many volumes as there are input volumes
             # --iout specifies the name of a 4D image file that contains unwarped and movement corrected images.
@@ -382,7 +384,7 @@ class TopupEddyEpi(cli.Application):
                   topup_params.split()] & FG
             
             # provide topupOutMean for quality checking
-            topupOutMean= 'topup_out_mean.nii.gz'
+            topupOutMean= 'topup_out_mean'+TMP_EXT
             fslmaths[topupOut, '-Tmean', topupOutMean] & FG
             
             
@@ -394,7 +396,7 @@ class TopupEddyEpi(cli.Application):
             
             # B0_PA_correct, B0_AP_correct are for quality checking only
             # primaryMaskCorrect, secondaryMaskCorrect will be associated masks
-            B0_PA_correct= 'B0_PA_corrected.nii.gz'
+            B0_PA_correct= 'B0_PA_corrected'+TMP_EXT
             applytopup[f'--imain={B0_PA}',
                        f'--datain={self.acqparams_file}',
                        '--inindex=1',
@@ -402,7 +404,7 @@ class TopupEddyEpi(cli.Application):
                        f'--out={B0_PA_correct}',
                        applytopup_params.split()] & FG
 
-            B0_AP_correct= 'B0_AP_corrected.nii.gz'
+            B0_AP_correct= 'B0_AP_corrected'+TMP_EXT
             applytopup[f'--imain={B0_AP}',
                        f'--datain={self.acqparams_file}',
                        '--inindex=2',
@@ -416,7 +418,7 @@ class TopupEddyEpi(cli.Application):
 
 
             
-            topupMask= 'topup_mask.nii.gz'
+            topupMask= 'topup_mask'+TMP_EXT
 
             # calculate topup mask
             if primaryMask and secondaryMask:
@@ -441,7 +443,7 @@ class TopupEddyEpi(cli.Application):
 
                 # binarise the mean of corrected primary,secondary mask to obtain modified mask
                 # use that mask for eddy_openmp
-                primaryMaskCorrect = 'primary_mask_corrected.nii.gz'
+                primaryMaskCorrect = 'primary_mask_corrected'+TMP_EXT
                 applytopup[f'--imain={primaryMask}',
                            f'--datain={self.acqparams_file}',
                            '--inindex=1',
@@ -449,7 +451,7 @@ class TopupEddyEpi(cli.Application):
                            f'--out={primaryMaskCorrect}',
                            applytopup_params.split()] & FG
 
-                secondaryMaskCorrect = 'secondary_mask_corrected.nii.gz'
+                secondaryMaskCorrect = 'secondary_mask_corrected'+TMP_EXT
                 applytopup[f'--imain={secondaryMask}',
                            f'--datain={self.acqparams_file}',
                            '--inindex=2',
@@ -481,7 +483,7 @@ class TopupEddyEpi(cli.Application):
                 # if --mask is not provided at all, this block creates a crude mask
                 # apply bet on the mean of topup output to obtain modified mask
                 # use that mask for eddy_openmp
-                bet[topupOutMean, topupMask.split('_mask.nii.gz')[0], '-m', '-n'] & FG
+                bet[topupOutMean, topupMask.split('_mask'+TMP_EXT)[0], '-m', '-n'] & FG
                 
 
                 
@@ -553,7 +555,7 @@ class TopupEddyEpi(cli.Application):
                 combinedBvecs = 'combinedBvecs.txt'
                 write_bvecs(combinedBvecs, bvecs1+bvecs2)
 
-                combinedData= 'combinedData.nii.gz'
+                combinedData= 'combinedData'+TMP_EXT
                 fslmerge('-t', combinedData, primaryMaskedVol, secondaryMaskedVol)
 
 
@@ -564,7 +566,14 @@ class TopupEddyEpi(cli.Application):
                 raise ValueError('Invalid --whichVol')
 
             # rename topupMask to have same prefix as that of eddy corrected volume
-            move(topupMask, outPrefix + '_mask.nii.gz')
+            compress_nifti(topupMask, outPrefix + '_mask.nii.gz')
+            remove(topupMask)
+
+            # FSL, including eddy, wrote uncompressed images in this scope,
+            # compress all of them so that outDir keeps .nii.gz files only
+            for img in sorted(glob('*.nii')):
+                compress_nifti(img, img + '.gz')
+                remove(img)
 
 
 
@@ -2,33 +2,63 @@
 
 from __future__ import print_function
 from os import getpid
-from util import logfmt, TemporaryDirectory, pjoin, FILEDIR, N_PROC, dirname
+import os, hashlib
+from util import logfmt, pjoin, N_PROC, dirname, cached_nifti, \
+    TMP_EXT, fsl_tmp_env, compress_nifti, run_commands
 from plumbum import local, cli, FG
 from plumbum.cmd import ls, flirt, fslmerge, tar, fslsplit
-import numpy as np
 import sys
-from multiprocessing import Pool
-from subprocess import check_call
 from conversion import read_bvecs, write_bvecs
+from bse import extract_b0
+from bvec_rotation import read_affines, polar_rotations, rotate_bvecs
 
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
 
+def _tmp_outputs(volnii):
+
+    vol= volnii.name.split('.')[0]
+    return volnii.dirname / ('tmp_'+volnii.name), volnii.dirname / ('tmp_'+vol+'.txt')
+
+
 def _Register_vol(volnii):
+    '''flirt command that registers volnii to the B0 in the current directory'''
+
+    tmpnii, tmptxt= _tmp_outputs(volnii)
+
+    return flirt['-interp' ,'sinc'
+                 ,'-sincwidth' ,'7'
+                 ,'-sincwindow' ,'blackman'
+                 ,'-in', volnii
+                 ,'-ref', 'b0'+TMP_EXT
+                 ,'-nosearch'
+                 ,'-o', tmpnii
+                 ,'-omat', tmptxt
+                 ,'-paddingsize', '1']
+
+
+def _Registered_vol(volnii):
+    '''Renames the flirt outputs of volnii to reg_<volnii> and <vol>.txt, the .txt last,
+    so a volume with a .txt is complete'''
+
+    tmpnii, tmptxt= _tmp_outputs(volnii)
+    os.replace(tmpnii, volnii.dirname / ('reg_'+volnii.name))
+    os.replace(tmptxt, volnii.dirname / (volnii.name.split('.')[0]+'.txt'))
+
+
+def _input_key(dwi, *files):
+    '''md5 keyed by path, mtime, and size of dwi, the contents of files (bvals, bvecs), and TMP_EXT,
+    so a modified input is registered again without reading the whole DWI'''
 
-    logging.info('Run FSL flirt affine registration')
-    flirt('-interp' ,'sinc'
-          ,'-sincwidth' ,'7'
-          ,'-sincwindow' ,'blackman'
-          ,'-in', volnii
-          ,'-ref', 'b0.nii.gz'
-          ,'-nosearch'
-          ,'-o', volnii
-          ,'-omat', volnii.with_suffix('.txt', depth=2)
-          ,'-paddingsize', '1')
+    stat= os.stat(dwi)
+    md5= hashlib.md5(f'{os.path.abspath(dwi)}:{stat.st_mtime_ns}:{stat.st_size}:{TMP_EXT}'.encode())
+    for f in files:
+        with open(f, 'rb') as fin:
+            md5.update(fin.read())
+
+    return md5.hexdigest()
 
-    return volnii
 
 class App(cli.Application):
     '''Eddy current correction.'''
@@ -42,6 +72,8 @@ class App(cli.Application):
     nproc = cli.SwitchAttr(
         ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
         becomes sluggish/you run into memory error, reduce --nproc''', default= N_PROC)
+    workdir = cli.SwitchAttr('--workdir', help='''directory of registered volumes and transforms, kept if registration fails
+        so that a rerun only registers the missing volumes, default: <out dir>/.<out name>-eddy-<hash of inputs>''')
 
     def main(self):
         self.out = local.path(self.out)
@@ -54,75 +86,53 @@ class App(cli.Application):
 
         outxfms = self.out.dirname / self.out.stem+'_xfms.tgz'
 
-        with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
-            tmpdir = local.path(tmpdir)
+        if self.workdir:
+            workdir= local.path(self.workdir)
+        else:
+            key= _input_key(self.dwi._path, self.bvalFile._path, self.bvecFile._path)
+            workdir= self.out.dirname / '.{}-eddy-{}'.format(self.out.name, key[:12])
+        workdir.mkdir()
+
+        with local.cwd(workdir), fsl_tmp_env():
+            tmpdir = workdir
 
             dicePrefix = 'vol'
 
-            logging.info('Dice the DWI')
-            fslsplit[self.dwi] & FG
+            if not (tmpdir / 'split.done').exists():
+                logging.info('Dice the DWI')
+                fslsplit[cached_nifti(self.dwi)] & FG
+                (tmpdir / 'split.done').touch()
 
             logging.info('Extract the B0')
-            check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', self.dwi._path, 
-                                   '--bvals', self.bvalFile, '-o', 'b0.nii.gz']), shell= True)
-
-            logging.info('Register each volume to the B0')
-            vols = sorted(tmpdir // (dicePrefix + '*.nii.gz'))
-
-            # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
-            res= pool.map_async(_Register_vol, vols)
-            volsRegistered= res.get()
-            pool.close()
-            pool.join()
-
-            # or use the following for loop
-            # volsRegistered = []
-            # for vol in vols:
-            #     volnii = vol.with_suffix('.nii.gz')
-            #     logging.info('Run FSL flirt affine registration')
-            #     flirt('-interp' ,'sinc'
-            #           ,'-sincwidth' ,'7'
-            #           ,'-sincwindow' ,'blackman'
-            #           ,'-in', volnii
-            #           ,'-ref', 'b0.nii.gz'
-            #           ,'-nosearch'
-            #           ,'-o', volnii
-            #           ,'-omat', volnii.with_suffix('.txt', depth=2)
-            #           ,'-paddingsize', '1')
-            #     volsRegistered.append(volnii)
-
-
-            fslmerge('-t', 'EddyCorrect-DWI.nii.gz', volsRegistered)
-            transforms = tmpdir.glob(dicePrefix+'*.txt')
-            transforms.sort()
+            extract_b0(self.dwi._path, self.bvalFile._path, 'b0'+TMP_EXT)
 
+            vols = sorted(tmpdir // (dicePrefix + '*'+TMP_EXT))
+            todo = [vol for vol in vols if not (tmpdir / (vol.name.split('.')[0]+'.txt')).exists()]
+            logging.info('Register each volume to the B0: {} of {} volumes are already registered in {}'
+                         .format(len(vols)-len(todo), len(vols), tmpdir))
 
-            logging.info('Extract the rotations and realign the gradients')
-
-            bvecs= read_bvecs(self.bvecFile._path)
-            bvecs_new= bvecs.copy()
-            for (i,t) in enumerate(transforms):
+            # flirt runs on threads, at most nproc at a time
+            try:
+                res= run_commands([_Register_vol(vol) for vol in todo], int(self.nproc),
+                                  done= lambda i: _Registered_vol(todo[i]))
+            except:
+                logging.error('Registration failed, run again to register only the remaining volumes in ' + tmpdir)
+                raise
+            if res:
+                logging.info('flirt took {:.1f}s per volume on average'.format(sum(r.seconds for r in res)/len(res)))
 
-                logging.info('Apply ' + t)
-                tra = np.loadtxt(t)
+            volsRegistered= [vol.dirname / ('reg_'+vol.name) for vol in vols]
 
-                # removes the translation
-                aff = np.matrix(tra[0:3,0:3])
 
-                # computes the finite strain of aff to get the rotation
-                rot = aff*aff.T
-
-                # compute the square root of rot
-                [el, ev] = np.linalg.eig(rot)
-                eL = np.identity(3)*np.sqrt(el)
-                sq = ev*eL*ev.I
+            fslmerge('-t', 'EddyCorrect-DWI'+TMP_EXT, volsRegistered)
+            transforms = [vol.dirname / (vol.name.split('.')[0]+'.txt') for vol in vols]
+            transforms.sort()
 
-                # finally the rotation is defined as
-                rot = sq.I*aff
 
-                bvecs_new[i] = np.dot(rot,bvecs[i]).tolist()[0]
+            logging.info('Extract the rotations and realign the gradients')
 
+            affines= read_affines(transforms)
+            bvecs_new= rotate_bvecs(read_bvecs(self.bvecFile._path), polar_rotations(affines)).tolist()
 
 
             tar('cvzf', outxfms, transforms)
@@ -131,7 +141,7 @@ class App(cli.Application):
             write_bvecs(self.out._path+'.bvec', bvecs_new)
 
             # save EddyCorrect-DWI
-            local.path('EddyCorrect-DWI.nii.gz').copy(self.out._path+'.nii.gz')
+            compress_nifti('EddyCorrect-DWI'+TMP_EXT, self.out._path+'.nii.gz', int(self.nproc))
 
             # copy bvals
             self.bvalFile.copy(self.out._path+'.bval')
@@ -139,6 +149,8 @@ class App(cli.Application):
             if self.debug:
                 tmpdir.copy(pjoin(dirname(self.out),"eddy-debug-"+str(getpid())))
 
+        workdir.delete()
+
 
 if __name__ == '__main__':
     App.run()
@@ -5,6 +5,7 @@ from os import getpid
 from plumbum import local, cli
 from plumbum.cmd import antsApplyTransforms, antsRegistration, fslmaths, WarpTimeSeriesImageMultiTransform
 from fs2dwi import rigid_registration
+from bse import extract_b0
 from subprocess import check_call
 from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC
 import sys
@@ -97,8 +98,7 @@ class App(cli.Application):
 
             logging.info('1. Extract B0 and and mask it')
             if not self.bse:
-                check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-m', self.dwimask, '-i', self.dwi, 
-                                       '--bvals', self.bvals_file, '-o', bse]), shell=True)
+                extract_b0(self.dwi._path, self.bvals_file._path, bse._path, mask=self.dwimask._path)
             else:
                 self.bse.copy(bse)
 
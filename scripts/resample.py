@@ -2,96 +2,200 @@
 
 import sys
 from nibabel import load, save, Nifti1Image
-from os.path import abspath, isfile
+from os.path import abspath, isfile, join as pjoin
 from shutil import copyfile
-from multiprocessing import Pool
-from glob import glob
-from plumbum import local, FG
-from plumbum.cmd import fslsplit, fslmerge
 from plumbum.cmd import ResampleImage
-import signal
 from tempfile import TemporaryDirectory
 import argparse
 import numpy as np
+from _volume_pool import shared_zeros, read_volumes, map_volumes, release
+from util import write_nifti
 
 N_CPU= 4
 
-def _resample_dwi(vol):
+# ResampleImage interpolation type: scipy spline order
+SPLINE_ORDER= {0: 1, 1: 0, 4: 5}
 
-    print('Resampling', vol)
 
-    ResampleImage('3', vol, vol.replace('.nii.gz', '_re.nii.gz'),
-                  args.size, args.size_spacing,
-                  args.order, '5' if args.order == 4 else '')
+def _ants_args(size, size_spacing, order):
+    return [size, size_spacing, order, '5' if order == 4 else '']
 
-def RAISE(ERR):
-    raise ERR
 
-def main():
-    
-    filename= abspath(args.input)
-    outPrefix= abspath(args.outPrefix)
-    if not isfile(filename):
-        raise FileNotFoundError(f'{filename} does not exist')
+def _size_spacing(size):
+    return '1' if np.array([float(x)>5 for x in size.strip().split('x')]).all() else '0'
 
-    img= load(filename)
 
-    args.size_spacing= '1' if np.array([float(x)>5 for x in args.size.strip().split('x')]).all() else '0'
+def is_mask(img):
+    '''True if the image has only 0 and 1 values, checked in the stored data type'''
 
-    if img.header['dim'][0]==4:
-        # DWI
-        with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
+    data= np.asanyarray(img.dataobj)
+    if data.max()!=1:
+        return False
+    if np.issubdtype(data.dtype, np.integer):
+        return data.min()==0
 
-            tmpdir= local.path(tmpdir)
+    return not np.any((data!=0) & (data!=1))
 
-            print('Working directory', tmpdir)
 
-            print('Splitting 4D')
-            fslsplit(filename, 'dwi', '-t')
+def resampled_grid(img, size):
+    '''Shape and affine of the image resampled by ResampleImage:
+    origin is unchanged, if size is given, spacing= old_spacing*(old_size-1)/(size-1),
+    if spacing is given, size= round(old_size*old_spacing/spacing)'''
 
-            volumes= glob('dwi*.nii.gz')
-            volumes.sort()
+    old_shape= np.array(img.shape[:3])
+    old_zooms= np.array(img.header.get_zooms()[:3], dtype=float)
 
-            sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-            pool= Pool(args.ncpu)
-            signal.signal(signal.SIGINT, sigint_handler)
-            try:
-                pool.map_async(_resample_dwi, volumes, error_callback=RAISE)
-            except KeyboardInterrupt:
-                pool.terminate()
+    if _size_spacing(size)=='1':
+        shape= np.array([int(x) for x in size.strip().split('x')])
+        zooms= old_zooms*(old_shape-1)/(shape-1)
+    else:
+        zooms= np.array([float(x) for x in size.strip().split('x')])
+        shape= (old_shape*old_zooms/zooms+0.5).astype(int)
+
+    affine= img.affine @ np.diag(np.append(zooms/old_zooms, 1))
+
+    return tuple(shape), affine
+
+
+def _zoom(img, affine):
+    # resampled voxel ijk maps to zoom*ijk in the input voxel space
+    return (np.linalg.inv(img.affine[:3, :3]) @ affine[:3, :3]).diagonal()
+
+
+def _resample_vol_ants(i, tmpdir, hdr, affine, size, order, src):
+
+    print('Resampling volume', i)
+    vol= pjoin(tmpdir, f'vol{i:04}.nii')
+    Nifti1Image(src[..., i], affine, hdr).to_filename(vol)
+    ResampleImage('3', vol, vol.replace('.nii', '_re.nii'), _ants_args(size, _size_spacing(size), order))
+
+    return load(vol.replace('.nii', '_re.nii'))
+
+
+def _resample_vols_ants(vols, tmpdir, hdr, affine, size, order, src, dst):
+
+    for i in vols:
+        dst[..., i]= _resample_vol_ants(i, tmpdir, hdr, affine, size, order, src).get_fdata(dtype=dst.dtype)
+
+
+def _resample_vols_scipy(vols, zoom, order, src, dst):
+    from scipy.ndimage import affine_transform
+
+    for i in vols:
+        print('Resampling volume', i)
+        affine_transform(src[..., i], zoom, output_shape=dst.shape[:3], output=dst[..., i],
+                         order=order, mode='nearest')
+
+
+def resample_dwi(filename, outPrefix, size, order=4, ncpu=N_CPU, engine='ants'):
+    '''Resample all volumes of a 4D image from one shared source array into one shared output array,
+    engine=ants runs ResampleImage for each volume, engine=scipy interpolates in-process'''
+
+    img= load(filename, mmap='r', keep_file_open=True)
+    N= img.shape[3]
+
+    hdr= img.header.copy()
+    hdr.set_data_shape(img.shape[:3])
+    hdr.set_data_dtype('float32')
+
+    shm_src, src= shared_zeros(img.shape, 'float32')
+    with TemporaryDirectory() as tmpdir:
+        try:
+            print('Reading 4D')
+            read_volumes(img, src)
+
+            if engine=='scipy':
+                shape, affine= resampled_grid(img, size)
+                func= _resample_vols_scipy
+                params= (_zoom(img, affine), SPLINE_ORDER[order])
+                vols= range(N)
             else:
-                pool.close()
-            pool.join()
+                # the first volume defines the output grid
+                vol0= _resample_vol_ants(0, tmpdir, hdr, img.affine, size, order, src)
+                shape, affine= vol0.shape[:3], vol0.affine
+                func= _resample_vols_ants
+                params= (tmpdir, hdr, img.affine, size, order)
+                vols= range(1, N)
+
+            shm_dst, dst= shared_zeros(shape+(N,), 'float32')
+            try:
+                if engine!='scipy':
+                    dst[..., 0]= vol0.get_fdata(dtype='float32')
 
+                map_volumes(func, {'src': (shm_src, src), 'dst': (shm_dst, dst)}, list(vols), ncpu, params,
+                            batch= int(np.ceil(N/ncpu)) if engine=='scipy' else 1)
 
-            volumes= glob('dwi*_re.nii.gz')
-            volumes.sort()
+                print('Writing 4D')
+                hdr.set_data_shape(dst.shape)
+                hdr.set_zooms(tuple(np.sqrt((affine[:3, :3]**2).sum(0)))+ img.header.get_zooms()[3:])
+                write_nifti(Nifti1Image(dst, affine, hdr), outPrefix+'.nii.gz', ncpu)
+            finally:
+                del dst
+                release(shm_dst)
+        finally:
+            del src
+            release(shm_src)
 
-            print('Merging 3Ds')
-            fslmerge['-t', outPrefix+'.nii.gz', volumes] & FG
+    inPrefix= filename.split('.nii')[0]
+    copyfile(inPrefix+'.bval', outPrefix+'.bval')
+    copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
 
-        inPrefix= filename.split('.nii')[0]
-        copyfile(inPrefix+'.bval', outPrefix+'.bval')
-        copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
 
-    else:
-        # mask
-        if sum(np.unique(img.get_fdata()))==1:
-            ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, args.size_spacing,
-                          '1', '2')
+def resample_3d(filename, outPrefix, size, order=4, engine='ants'):
+    '''Resample a T1w/T2w/mask, masks are detected from their values and resampled with nearest neighbor'''
+
+    img= load(filename)
+    mask= is_mask(img)
+
+    if engine=='scipy':
+        from scipy.ndimage import affine_transform
+
+        shape, affine= resampled_grid(img, size)
+        data= affine_transform(img.get_fdata(dtype='float32'), _zoom(img, affine), output_shape=shape,
+                               order=0 if mask else SPLINE_ORDER[order], mode='nearest')
 
-        # T1w/T2w
+        hdr= img.header.copy()
+        hdr.set_zooms(np.sqrt((affine[:3, :3]**2).sum(0)))
+        if mask:
+            data= data.astype(img.get_data_dtype())
         else:
-            ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, args.size_spacing,
-                          args.order, '5' if args.order==4 else '')
+            hdr.set_data_dtype('float32')
+        write_nifti(Nifti1Image(data, affine, hdr), outPrefix+'.nii.gz')
+
+    # mask
+    elif mask:
+        ResampleImage('3', filename, outPrefix+'.nii.gz', size, _size_spacing(size), '1', '2')
+
+    # T1w/T2w
+    else:
+        ResampleImage('3', filename, outPrefix+'.nii.gz', _ants_args(size, _size_spacing(size), order))
+
+
+def main():
+
+    filename= abspath(args.input)
+    outPrefix= abspath(args.outPrefix)
+    if not isfile(filename):
+        raise FileNotFoundError(f'{filename} does not exist')
+
+    if args.engine=='scipy' and args.order not in SPLINE_ORDER:
+        raise ValueError(f'--engine scipy supports --order {list(SPLINE_ORDER)} only')
+
+    if load(filename).header['dim'][0]==4:
+        # DWI
+        resample_dwi(filename, outPrefix, args.size, args.order, args.ncpu, args.engine)
+
+    else:
+        resample_3d(filename, outPrefix, args.size, args.order, args.engine)
 
 
 
 if __name__=='__main__':
 
     parser = argparse.ArgumentParser(
-        description="""Resample an MRI using ANTs ResampleImage executable. 
-If the image is 4D, it is split to 3D along the last axis, resampled at 3D level, and merged back.""")
+        description="""Resample an MRI using ANTs ResampleImage executable.
+If the image is 4D, its volumes are read once into shared memory, resampled at 3D level,
+and written into one 4D output.""")
 
     parser.add_argument('-i','--input', help='input3D/4D MRI')
     parser.add_argument('-o', '--outPrefix',
@@ -100,16 +204,17 @@ If the image is 4D, it is split to 3D along the last axis, resampled at 3D level
     parser.add_argument('--ncpu', default= N_CPU, type= int,
                         help='default %(default)s, you can increase it at the expense of RAM')
 
-    parser.add_argument('--size', help="""resample to MxNxO size or resolution, 
+    parser.add_argument('--size', help="""resample to MxNxO size or resolution,
 if all of M,N,O<5, it is interpreted as resolution""")
 
-    parser.add_argument('--order', default=4,
-                        help="""For details about order of interpolation, see ResampleImage --help, 
+    parser.add_argument('--order', default=4, type= int,
+                        help="""For details about order of interpolation, see ResampleImage --help,
 the default for masks is 1 (nearest neighbor) while for all other images it is 4 (Bspline [order=5])""")
 
+    parser.add_argument('--engine', default='ants', choices=['ants', 'scipy'],
+                        help="""ants: ResampleImage for each volume,
+scipy: in-process spline interpolation on the same grid, supports --order 0, 1, and 4""")
+
     args = parser.parse_args()
 
     main()
-
-
-
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from plumbum import cli
+import numpy as np
+import nibabel
+
+
+def read_polydata(filename):
+    import vtk
+
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    outpd = reader.GetOutput()
+    del reader
+
+    return outpd
+
+
+def line_points(inpd):
+    '''Coordinates of all points visited by the lines of a vtkPolyData as an Nx3 array,
+    a point shared by several lines appears once for each of them'''
+
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    points = vtk_to_numpy(inpd.GetPoints().GetData())
+    lines = inpd.GetLines()
+
+    if hasattr(lines, 'GetConnectivityArray'):
+        # VTK>=9 keeps point ids of all lines in one array
+        ids = vtk_to_numpy(lines.GetConnectivityArray())
+    else:
+        # legacy layout: n0, id_1, ..., id_n0, n1, id_1, ...
+        legacy = vtk_to_numpy(lines.GetData())
+        keep = np.ones(len(legacy), dtype=bool)
+        pos = 0
+        for _ in range(inpd.GetNumberOfLines()):
+            keep[pos] = False
+            pos += legacy[pos]+1
+        ids = legacy[keep]
+
+    return points[ids]
+
+
+def tract_density(points, shape, affine):
+    '''Number of points in each voxel of an image with shape and affine,
+    points are assigned to their nearest voxel'''
+
+    inv = np.linalg.inv(affine)
+    ijk = np.rint(points @ inv[:3, :3].T + inv[:3, 3]).astype(np.int64)
+
+    shape = tuple(shape[:3])
+    # same as indexing the volume with ijk: negative indices count from the end, others must be inside
+    ijk = np.where(ijk < 0, ijk+shape, ijk)
+    flat = np.ravel_multi_index(ijk.T, shape)
+
+    return np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape).astype(float)
+
+
+def tract2vol(tract_name, volume_name):
+    '''Streamline density of a vtk tract file on the grid of a nifti image, only the header is read'''
+
+    volume = nibabel.load(volume_name)
+    return tract_density(line_points(read_polydata(tract_name)), volume.shape, volume.affine)
+
+
+class App(cli.Application):
+    '''Streamline density map: number of tract points in each voxel of a reference image'''
+
+    tract = cli.SwitchAttr(['-i', '--input'], cli.ExistingFile, help='input vtk tract file', mandatory=True)
+    ref = cli.SwitchAttr(['-r', '--ref'], cli.ExistingFile, help='reference nifti image defining the grid', mandatory=True)
+    out = cli.SwitchAttr(['-o', '--output'], help='output density map', mandatory=True)
+
+    def main(self):
+
+        from util import write_nifti
+
+        ref = nibabel.load(self.ref._path)
+        density = tract_density(line_points(read_polydata(self.tract._path)), ref.shape, ref.affine)
+
+        hdr = ref.header.copy()
+        hdr.set_data_shape(density.shape)
+        hdr.set_data_dtype('float32')
+        write_nifti(nibabel.Nifti1Image(density, ref.affine, hdr), self.out)
+
+
+if __name__ == '__main__':
+    App.run()
@@ -50,10 +50,10 @@ class App(cli.Application):
 
             # TODO when UKFTractography supports float32, it should be removed
             # typecast to short
-            short= load_nifti(self.dwi._path)
+            short= load_nifti(self.dwi._path, cache=True)
             save_nifti(shortdwi._path, short.get_data().astype('int16'), short.affine, short.header)
 
-            short= load_nifti(self.dwimask._path)
+            short= load_nifti(self.dwimask._path, cache=True)
             save_nifti(shortmask._path, short.get_data().astype('int16'), short.affine, short.header)
 
 
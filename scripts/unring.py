@@ -3,7 +3,7 @@
 import sys
 from dipy.denoise.gibbs import gibbs_removal
 from nibabel import load, save, Nifti1Image
-# from util import save_nifti
+from util import TMP_EXT, fsl_tmp_env, write_nifti, compress_nifti
 from os.path import abspath, isfile
 from shutil import copyfile
 from multiprocessing import Pool
@@ -12,6 +12,34 @@ from plumbum import local, FG
 from plumbum.cmd import fslsplit, fslmerge
 import signal
 from tempfile import TemporaryDirectory
+import numpy as np
+from _volume_pool import shared_zeros, read_volumes, map_volumes, release
+
+
+def _unring_vols(vols, dwi):
+
+    for i in vols:
+        print('unringing volume', i)
+        dwi[..., i]= gibbs_removal(np.array(dwi[..., i]))
+
+
+def unring_mmap(filename, outPrefix, N_CPU):
+    '''Unring all volumes of a 4D image in one shared array,
+    the volumes are read once and the result is written once'''
+
+    img= load(filename, mmap='r', keep_file_open=True)
+    dtype= 'float64' if img.get_data_dtype().itemsize>4 else 'float32'
+
+    shm, dwi= shared_zeros(img.shape, dtype)
+    try:
+        read_volumes(img, dwi)
+        map_volumes(_unring_vols, {'dwi': (shm, dwi)}, img.shape[3], N_CPU)
+
+        # header keeps the input data type, nibabel scales the output if needed
+        write_nifti(Nifti1Image(dwi, affine= img.affine, header= img.header), outPrefix+'.nii.gz', N_CPU)
+    finally:
+        del dwi
+        release(shm)
 
 
 def _unring(vol):
@@ -24,35 +52,54 @@ def _unring(vol):
     outPrefix= vol.split('.nii')[0]+ '_ur'
     
     new_image= Nifti1Image(unringed, affine= img.affine, header= img.header)
-    new_image.to_filename(outPrefix+'.nii.gz')
+    new_image.to_filename(outPrefix+TMP_EXT)
 
 
 
 def main():
     
+    if '--split' in sys.argv:
+        sys.argv.remove('--split')
+        split= True
+    else:
+        split= False
+
     filename= abspath(sys.argv[1])
     outPrefix= abspath(sys.argv[2])
     if not isfile(filename):
         raise FileNotFoundError(f'{filename} does not exist')
-    
-    
+
+    try:
+        N_CPU= int(sys.argv[3])
+    except:
+        N_CPU= 4
+
+    if not split:
+        unring_mmap(filename, outPrefix, N_CPU)
+
+    else:
+        _unring_split(filename, outPrefix, N_CPU)
+
+    inPrefix= filename.split('.nii')[0] 
+    copyfile(inPrefix+'.bval', outPrefix+'.bval')
+    copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
+
+
+def _unring_split(filename, outPrefix, N_CPU):
+
     with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
         
         tmpdir= local.path(tmpdir)
 
         print('Working directory', tmpdir)
         
-        fslsplit(filename, 'dwi', '-t')
+        with fsl_tmp_env():
+            fslsplit(filename, 'dwi', '-t')
         
-        volumes= glob('dwi*.nii.gz')
+        volumes= glob('dwi*'+TMP_EXT)
         volumes.sort()
 
         sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        
-        try:
-            N_CPU= int(sys.argv[3])
-        except:
-            N_CPU= 4
 
         pool= Pool(N_CPU)
         signal.signal(signal.SIGINT, sigint_handler)
@@ -65,21 +112,21 @@ def main():
         pool.join()
         
         
-        volumes= glob('dwi*_ur.nii.gz')
+        volumes= glob('dwi*_ur'+TMP_EXT)
         volumes.sort()
-        fslmerge['-t', outPrefix+'.nii.gz', volumes] & FG
-
-    inPrefix= filename.split('.nii')[0] 
-    copyfile(inPrefix+'.bval', outPrefix+'.bval')
-    copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
+        with fsl_tmp_env():
+            fslmerge['-t', 'dwi_ur', volumes] & FG
+        compress_nifti('dwi_ur'+TMP_EXT, outPrefix+'.nii.gz', N_CPU)
 
 
 if __name__=='__main__':
     if len(sys.argv)==1 or sys.argv[1]=='-h' or sys.argv[1]=='--help':
         print('Usage:\n'
-              'unring.py <dwi> <outPrefix> <ncpu>\n'
+              'unring.py <dwi> <outPrefix> <ncpu> [--split]\n'
               'Gibbs unringing of all DWI gradients using DIPY\n'
-              'Default ncpu=4, you can increase it at the expense of RAM\n')
+              'Default ncpu=4, you can increase it at the expense of RAM\n'
+              'The DWI is read once into shared memory and unringed volumes are written back to it, '
+              'use --split to dice the DWI with fslsplit and merge with fslmerge instead\n')
         exit()
 
 
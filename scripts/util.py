@@ -4,7 +4,7 @@ from os.path import abspath, dirname, join as pjoin, isfile
 import os
 from plumbum import local
 from tempfile import mkdtemp
-import weakref, shutil
+import weakref, shutil, io
 
 FILEDIR= abspath(dirname(__file__))
 LIBDIR= dirname(FILEDIR)
@@ -28,10 +28,138 @@ if not TMPDIR.exists():
 import warnings
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
-    from nibabel import load as load_nifti, Nifti1Image
+    from nibabel import load as _load, Nifti1Image
 
 
-def save_nifti(fname, data, affine, hdr=None):
+# uncompressed copies of .nii.gz inputs shared by all steps of a case, set PNLPIPE_READ_CACHE_GB=0 to disable
+# copies are kept in one directory for each case, see clear_read_cache()
+READ_CACHE= TMPDIR / 'pnlpipe-read-cache'
+READ_CACHE_SIZE= float(os.getenv('PNLPIPE_READ_CACHE_GB', 20))*1024**3 # bytes
+READ_CACHE_GRACE= 600 # seconds
+
+
+def _case_cache(filename):
+    '''READ_CACHE directory of the BIDS case of filename: sub-<id>[_ses-<ses>] from its path,
+    files outside a case e.g. training images of atlas.py share one directory'''
+
+    parts= dirname(abspath(filename)).split(os.sep)
+    sub= [p for p in parts if p.startswith('sub-')]
+    ses= [p for p in parts if p.startswith('ses-')]
+    if not sub:
+        return READ_CACHE / 'shared'
+
+    return READ_CACHE / ('_'.join([sub[-1]]+ ses[-1:]))
+
+
+def clear_read_cache(id, ses=''):
+    '''Remove the cached copies of a case once its pipeline is finished'''
+
+    name= f'sub-{id}_ses-{ses}' if ses else f'sub-{id}'
+    shutil.rmtree(READ_CACHE / name, ignore_errors=True)
+
+
+def _evict(limit, grace=READ_CACHE_GRACE):
+    '''Remove least recently used files from READ_CACHE until its size is under limit, returns the size.
+    Files used within the last grace seconds are kept: cached_nifti() returned them to a process
+    that may not have opened them yet. Partial copies of other processes count but are kept too.'''
+
+    import time
+
+    recent= time.time()-grace
+    total= 0
+    files= []
+    for case in os.scandir(READ_CACHE):
+        if not case.is_dir():
+            continue
+        try:
+            entries= list(os.scandir(case.path))
+        except FileNotFoundError:
+            # case removed by clear_read_cache()
+            continue
+        for f in entries:
+            try:
+                stat= f.stat()
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            total+= stat.st_size
+            if not f.name.endswith('.tmp'):
+                files.append((stat.st_mtime, stat.st_size, f.path))
+
+    for mtime, size, path in sorted(files):
+        if total<=limit or mtime>recent:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total-= size
+
+    return total
+
+
+def cached_nifti(filename):
+    '''Path to an uncompressed, memory-mappable copy of filename in READ_CACHE.
+    Copies are keyed by absolute path, mtime, and size, so a rewritten input is decompressed again.
+    Uncompressed files, and files for which the cache cannot make room, are returned as is.'''
+
+    filename= str(filename)
+    if not filename.endswith('.nii.gz') or READ_CACHE_SIZE<=0:
+        return filename
+
+    import gzip, hashlib
+    from math import prod
+
+    stat= os.stat(filename)
+    key= hashlib.md5(f'{abspath(filename)}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+    casedir= _case_cache(filename)
+    cached= pjoin(casedir, key+ '_'+ os.path.basename(filename)[:-3])
+
+    if isfile(cached):
+        # mtime of cached files orders them for eviction
+        try:
+            os.utime(cached)
+            return cached
+        except FileNotFoundError:
+            pass
+
+    # uncompressed size from the header, the copy is made only if the cache stays under its size with it
+    hdr= _load(filename).header
+    size= int(hdr.get_data_offset())+ prod(hdr.get_data_shape())*hdr.get_data_dtype().itemsize
+    casedir.mkdir()
+    if _evict(READ_CACHE_SIZE-size)+size>READ_CACHE_SIZE:
+        return filename
+
+    # decompress to a unique name and rename, so concurrent readers never see a partial file
+    tmp= f'{cached}.{os.getpid()}.tmp'
+    try:
+        with gzip.open(filename, 'rb') as fin, open(tmp, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 16*1024**2)
+        os.replace(tmp, cached)
+    except OSError:
+        # full or read-only TMPDIR, or case removed by clear_read_cache(), read the original instead
+        if isfile(tmp):
+            os.remove(tmp)
+        return filename
+
+    return cached
+
+
+def load_nifti(filename, cache=False, **kwargs):
+    '''nibabel.load(), with cache=True through the read cache: .nii.gz files are memory-mapped from
+    their uncompressed copies. Use it for inputs whose voxel data are read, not when only the header is needed.'''
+
+    if cache:
+        try:
+            return _load(cached_nifti(filename), **kwargs)
+        except FileNotFoundError:
+            # evicted by another process, read the original
+            pass
+
+    return _load(str(filename), **kwargs)
+
+
+def save_nifti(fname, data, affine, hdr=None, nproc=None):
     if data.dtype.name=='uint8':
         hdr.set_data_dtype('uint8')
     elif data.dtype.name=='int16':
@@ -40,7 +168,46 @@ def save_nifti(fname, data, affine, hdr=None):
         hdr.set_data_dtype('float32')
 
     result_img = Nifti1Image(data, affine, header=hdr)
-    result_img.to_filename(fname)
+    write_nifti(result_img, fname, nproc)
+
+
+# output of `<tool> --version` keyed by binary path and mtime, shared by all processes of a node
+VERSION_CACHE= TMPDIR / 'pnlpipe-versions'
+
+
+def tool_version(name, flag='--version'):
+    '''Output of `name flag`, run once per process and per installed binary:
+    results are cached in memory and in VERSION_CACHE by path and mtime of the binary,
+    so an upgraded tool is probed again'''
+
+    path= str(local.which(name))
+    return _tool_version(path, os.stat(path).st_mtime_ns, flag)
+
+
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def _tool_version(path, mtime, flag):
+
+    import hashlib
+
+    cached= pjoin(VERSION_CACHE, hashlib.md5(f'{path}:{mtime}:{flag}'.encode()).hexdigest())
+    if isfile(cached):
+        with open(cached) as f:
+            return f.read()
+
+    version= local[path](flag)
+    try:
+        VERSION_CACHE.mkdir()
+        tmp= f'{cached}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(version)
+        os.replace(tmp, cached)
+    except OSError:
+        # read-only TMPDIR, probe again in the next process
+        pass
+
+    return version
 
 
 def logfmt(scriptname):
@@ -50,6 +217,294 @@ import psutil
 N_CPU= psutil.cpu_count()
 
 
+def n_threads(nproc=None):
+    '''nproc if given, else the cores held by the calling task through cpu_slots (OMP_NUM_THREADS), else all cores'''
+
+    return max(1, int(nproc or os.getenv('OMP_NUM_THREADS') or N_CPU))
+
+# cores of this node shared by all pipeline tasks, set PNLPIPE_CPUS=0 to disable the budget
+CPU_TOKENS= TMPDIR / 'pnlpipe-cpus'
+CPU_BUDGET= int(os.getenv('PNLPIPE_CPUS', N_CPU))
+CPU_POLL= 5 # seconds
+THREAD_VARS= ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS']
+
+
+class cpu_slots(object):
+    '''Hold up to n of the CPU_BUDGET cores of this node:
+        with cpu_slots(8) as n:
+            check_call(f'pnl_eddy.py ... -n {n}', shell=True)
+    Waits until a core is free, then takes as many free cores as possible up to n,
+    so tasks started on an idle node get all they ask for and tasks on a busy node fewer.
+    Each core is a file lock under CPU_TOKENS, released when the block exits or the process dies.
+    ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS and OMP_NUM_THREADS are set to the number of cores within the block.'''
+
+    def __init__(self, n, poll=CPU_POLL):
+        self.n= max(1, int(n))
+        self.poll= poll
+        self.fds= []
+        self.env= {}
+
+    def _acquire(self):
+        import fcntl
+
+        for k in range(CPU_BUDGET):
+            if len(self.fds)==self.n:
+                break
+            fd= os.open(pjoin(CPU_TOKENS, f'cpu{k}'), os.O_CREAT | os.O_RDWR, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.fds.append(fd)
+            except OSError:
+                # held by another task
+                os.close(fd)
+
+    def __enter__(self):
+        if CPU_BUDGET<=0:
+            return self.n
+
+        import time
+
+        CPU_TOKENS.mkdir()
+        self.n= min(self.n, CPU_BUDGET)
+        self._acquire()
+        while not self.fds:
+            time.sleep(self.poll)
+            self._acquire()
+
+        n= len(self.fds)
+        for var in THREAD_VARS:
+            self.env[var]= os.environ.get(var)
+            os.environ[var]= str(n)
+
+        return n
+
+    def __exit__(self, exc, value, tb):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds= []
+
+        for var, val in self.env.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var]= val
+
+
+GZIP_BLOCK= 4*1024**2 # bytes
+GZIP_LEVEL= 1 # same as nibabel
+
+
+class GzipBlockWriter(io.IOBase):
+    '''Writable binary stream that compresses what is written to it into the writable binary stream fout
+    as consecutive gzip members of blocksize bytes each, compressed by nproc threads.
+    zlib releases the GIL, and gzip readers, including nibabel and FSL/ANTs (zlib), read the members as one stream.
+    The stream only goes forward: seek() to another position raises OSError, nibabel then writes zeros instead.'''
+
+    def __init__(self, fout, nproc=None, blocksize=GZIP_BLOCK, level=GZIP_LEVEL):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.fout= fout
+        self.nproc= n_threads(nproc)
+        self.blocksize= blocksize
+        self.level= level
+        self.pool= ThreadPoolExecutor(self.nproc)
+        self.pending= deque()
+        self.buffer= bytearray()
+        self.pos= 0
+
+    def _submit(self, block):
+        import gzip
+
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level))
+        if len(self.pending)>=2*self.nproc:
+            self.fout.write(self.pending.popleft().result())
+
+    def write(self, data):
+        data= memoryview(data).cast('B')
+        self.buffer+= data
+        self.pos+= len(data)
+        while len(self.buffer)>=self.blocksize:
+            self._submit(bytes(self.buffer[:self.blocksize]))
+            del self.buffer[:self.blocksize]
+
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence==0 and offset==self.pos:
+            return self.pos
+        raise OSError('GzipBlockWriter only writes forward')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.pool is None:
+            return
+
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer= bytearray()
+            while self.pending:
+                self.fout.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.pool= None
+            super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        if exc is None:
+            self.close()
+        else:
+            # discard blocks of a failed write
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+            self.pool= None
+            super().close()
+
+
+def write_gzip(fin, fout, nproc=None, blocksize=GZIP_BLOCK, level=GZIP_LEVEL):
+    '''Compress the readable binary stream fin into the writable binary stream fout with GzipBlockWriter'''
+
+    with GzipBlockWriter(fout, nproc, blocksize, level) as writer:
+        shutil.copyfileobj(fin, writer, blocksize)
+
+
+# intermediate images are written uncompressed, set PNLPIPE_COMPRESS_TMP=1 to write .nii.gz intermediates
+COMPRESS_TMP= os.getenv('PNLPIPE_COMPRESS_TMP', '0')=='1'
+TMP_EXT= '.nii.gz' if COMPRESS_TMP else '.nii'
+FSLOUTPUTTYPE= 'NIFTI_GZ' if COMPRESS_TMP else 'NIFTI'
+
+
+def fsl_tmp_env():
+    '''Environment for FSL commands that write intermediate images:
+        with fsl_tmp_env():
+            fslsplit(...)
+    FSL replaces the extension of an output with the one of FSLOUTPUTTYPE,
+    so final outputs must not be written by FSL commands run in this environment.'''
+
+    return local.env(FSLOUTPUTTYPE=FSLOUTPUTTYPE)
+
+
+def compress_nifti(src, dst, nproc=None):
+    '''Write the image src as dst, compressed by write_gzip() if dst is .nii.gz and src is not, copied otherwise'''
+
+    src, dst= str(src), str(dst)
+    if dst.endswith('.gz') and not src.endswith('.gz'):
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            write_gzip(fin, fout, nproc)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def write_nifti(img, fname, nproc=None):
+    '''img.to_filename(fname), a .nii.gz is streamed into GzipBlockWriter and compressed by nproc threads'''
+
+    fname= str(fname)
+    if not fname.endswith('.nii.gz'):
+        img.to_filename(fname)
+        return
+
+    file_map= img.file_map
+    with open(fname, 'wb') as fout, GzipBlockWriter(fout, nproc) as writer:
+        img.to_file_map(img.make_file_map({'image': writer, 'header': writer}))
+    # the writer is closed, keep the image associated with its original files
+    img.file_map= file_map
+
+
+# external commands run on threads: the workers only wait on their subprocesses,
+# so forking the heap of the parent for each of them is not needed
+from collections import namedtuple
+import threading
+
+CommandResult= namedtuple('CommandResult', ['cmd', 'returncode', 'seconds'])
+_RUNNING= set()
+_RUNNING_LOCK= threading.Lock()
+
+
+def _wait_all(pool, futures):
+    '''Wait for futures, stop at the first exception: pending calls are cancelled and the exception is raised
+    once the running calls are finished. On KeyboardInterrupt, running commands are terminated too.'''
+
+    from concurrent.futures import wait, FIRST_EXCEPTION
+
+    try:
+        done, _= wait(futures, return_when=FIRST_EXCEPTION)
+        for f in futures:
+            if f.done() and not f.cancelled() and f.exception():
+                for g in futures:
+                    g.cancel()
+                pool.shutdown(wait=True)
+                raise f.exception()
+    except KeyboardInterrupt:
+        for g in futures:
+            g.cancel()
+        with _RUNNING_LOCK:
+            for p in _RUNNING:
+                p.terminate()
+        pool.shutdown(wait=True)
+        raise
+
+    pool.shutdown(wait=True)
+    return [f.result() for f in futures]
+
+
+def run_threads(func, items, nproc=None):
+    '''[func(item) for item in items] on nproc threads, for functions that mostly wait on external commands.
+    The first exception is raised after cancelling the pending calls.'''
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool= ThreadPoolExecutor(n_threads(nproc))
+    return _wait_all(pool, [pool.submit(func, item) for item in items])
+
+
+def _run_command(i, cmd, check, done):
+    import subprocess, time
+
+    # plumbum commands are given as cmd['arg', ...], run them in the cwd and environment of plumbum.local
+    argv= cmd.formulate() if hasattr(cmd, 'formulate') else [str(c) for c in cmd]
+    start= time.time()
+    p= subprocess.Popen(argv, cwd=str(local.cwd), env=local.env.getdict())
+    with _RUNNING_LOCK:
+        _RUNNING.add(p)
+    try:
+        p.wait()
+    finally:
+        with _RUNNING_LOCK:
+            _RUNNING.discard(p)
+
+    if p.returncode and check:
+        raise subprocess.CalledProcessError(p.returncode, argv)
+    if not p.returncode and done:
+        done(i)
+
+    return CommandResult(argv, p.returncode, time.time()-start)
+
+
+def run_commands(cmds, nproc=None, check=True, done=None):
+    '''Run external commands, at most nproc at a time. cmds are argument lists or plumbum commands.
+    done(i) is called after cmds[i] succeeds. Returns a CommandResult(cmd, returncode, seconds) for each command.
+    With check, a failure cancels the pending commands and raises CalledProcessError
+    once the running ones are finished. On SIGINT, the pending commands are cancelled and the running ones terminated.'''
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool= ThreadPoolExecutor(n_threads(nproc))
+    return _wait_all(pool, [pool.submit(_run_command, i, cmd, check, done) for i, cmd in enumerate(cmds)])
+
+
 # the following context manager is copied from https://github.com/python/cpython/blob/master/Lib/tempfile.py#L762
 class TemporaryDirectory(object):
     """Create and return a temporary directory.  This has the same
@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC, FILEDIR
+from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC, FILEDIR, run_commands
 from plumbum import local, cli, FG
-from subprocess import check_call
-from multiprocessing import Pool
 
 import logging
 logger = logging.getLogger()
@@ -15,8 +13,7 @@ def nrrd(f):
 
 def _activateTensors_py(vtk):
     vtknew = vtk.dirname / (vtk.stem[2:] + ''.join(vtk.suffixes))
-    check_call((' ').join([pjoin(FILEDIR,'activateTensors.py'), vtk, vtknew]), shell= True)
-    vtk.delete()
+    return [pjoin(FILEDIR,'activateTensors.py'), vtk, vtknew]
 
 
 class App(cli.Application):
@@ -72,16 +69,18 @@ class App(cli.Application):
 
             logging.info('Convert vtk field data to tensor data')
 
-            # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
-            pool.map_async(_activateTensors_py, self.out.glob('*.vtk'))
-            pool.close()
-            pool.join()
+            # activateTensors.py runs on threads, at most nproc at a time
+            vtks= self.out.glob('*.vtk')
+            res= run_commands([_activateTensors_py(vtk) for vtk in vtks], int(self.nproc), check=False,
+                              done= lambda i: vtks[i].delete())
+            for vtk, r in zip(vtks, res):
+                if r.returncode:
+                    logging.warning('activateTensors.py failed for {} with exit code {}'.format(vtk, r.returncode))
 
             # or use the following for loop
+            # from subprocess import check_call
             # for vtk in self.out.glob('*.vtk'):
-            #     vtknew = vtk.dirname / (vtk.stem[2:] + ''.join(vtk.suffixes))
-            #     _activateTensors_py(vtk, vtknew)
+            #     check_call(_activateTensors_py(vtk))
             #     vtk.delete()
 
 if __name__ == '__main__':
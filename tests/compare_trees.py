@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+'''Compare every reference file under a tree with its counterpart under outroot using the checks of test_luigi.py,
+files are the same as those selected by equality_tests() in pipeline_test.sh'''
+
+from plumbum import cli
+from os.path import abspath, basename, dirname, getsize, isfile, join as pjoin, relpath
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from contextlib import redirect_stdout
+import io, json, os, signal, time, traceback
+
+import test_luigi
+
+CHUNK= 16*1024**2 # bytes
+# tracts compared by pipeline_test.sh, others have no b0 reference
+TRACT_PATTERN= 'sub-1004*EdEp.vtk'
+
+
+def same_content(gt_name, out_name, chunk=CHUNK):
+    '''Byte by byte comparison of two files, stops at the first differing chunk'''
+
+    if getsize(gt_name)!=getsize(out_name):
+        return False
+
+    with open(gt_name, 'rb') as f, open(out_name, 'rb') as g:
+        while True:
+            a= f.read(chunk)
+            if a!=g.read(chunk):
+                return False
+            if not a:
+                return True
+
+
+def select_checks(filename):
+    '''Names of the test_luigi checks that apply to a reference file'''
+
+    name= basename(filename)
+    checks= []
+    if name.endswith('.nii.gz') and '/fs2dwi/' not in filename:
+        checks+= ['test_header', 'test_data']
+    if name.startswith('wmparc'):
+        checks.append('test_wmparc')
+    if fnmatch(name, TRACT_PATTERN):
+        checks.append('test_tracts')
+
+    ext_checks= {'.bval': 'test_bvals', '.bvec': 'test_bvecs', '.csv': 'test_wmql',
+                 '.json': 'test_json', '.html': 'test_html'}
+    for ext, check in ext_checks.items():
+        if name.endswith(ext):
+            checks.append(check)
+
+    return checks
+
+
+def tract_params(gt_name, out_name):
+    '''test_tracts() compares a tract together with the b0 of the DWI it was computed from,
+    tracts/<prefix>_desc-<desc>.vtk comes with dwi/<prefix>_desc-dwi<desc>_bse.nii.gz of BseExtract'''
+
+    bse= lambda tract: pjoin(dirname(tract).replace('/tracts', '/dwi'),
+                             basename(tract).replace('_desc-', '_desc-dwi').replace('.vtk', '_bse.nii.gz'))
+    return {'gt_name': f'{bse(gt_name)},{gt_name}', 'out_name': f'{bse(out_name)},{out_name}'}
+
+
+def compare_file(args):
+    '''Run the checks of one reference file, returns a report entry'''
+
+    gt_name, out_name, checks= args
+    entry= {'file': gt_name, 'checks': checks}
+    start= time.time()
+
+    if not isfile(out_name):
+        entry['status']= 'missing'
+
+    elif 'test_tracts' not in checks and same_content(gt_name, out_name):
+        entry['status']= 'identical'
+
+    else:
+        entry['status']= 'pass'
+        entry['results']= {}
+        for check in checks:
+            params= tract_params(gt_name, out_name) if check=='test_tracts' \
+                else {'gt_name': gt_name, 'out_name': out_name}
+
+            log= io.StringIO()
+            try:
+                with redirect_stdout(log):
+                    getattr(test_luigi, check)(params)
+                status= 'pass'
+            except AssertionError as e:
+                status= 'fail'
+                print(e, file=log)
+            except Exception:
+                status= 'error'
+                print(traceback.format_exc(), file=log)
+
+            entry['results'][check]= {'status': status, 'output': log.getvalue().strip()}
+            if status!='pass' and entry['status']=='pass':
+                entry['status']= status
+
+    entry['seconds']= round(time.time()-start, 3)
+
+    return entry
+
+
+class App(cli.Application):
+    '''Compare a reference derivatives tree with the output of a pipeline run,
+    writes one JSON report with the outcome of each file'''
+
+    ref = cli.SwitchAttr(['-r', '--ref'], cli.ExistingDirectory,
+                         help='reference directory, default: tests/Reference',
+                         default=pjoin(abspath(dirname(__file__)), 'Reference'))
+    outroot = cli.SwitchAttr(['--outroot'], cli.ExistingDirectory,
+                             help='root directory containing CTE/ and HCP/ folders', mandatory=True)
+    report = cli.SwitchAttr(['-o', '--output'], help='output JSON report', mandatory=True)
+    nproc = cli.SwitchAttr(['-n', '--nproc'], help='number of files compared in parallel', default=4)
+
+    def main(self):
+
+        ref= abspath(self.ref)
+        outroot= abspath(self.outroot)
+
+        jobs= []
+        for root, _, files in os.walk(ref):
+            for name in sorted(files):
+                gt_name= pjoin(root, name)
+                checks= select_checks(gt_name)
+                if checks:
+                    jobs.append((gt_name, gt_name.replace(ref, outroot), checks))
+
+        # largest files first so that they do not finish last
+        jobs.sort(key=lambda job: -getsize(job[0]))
+
+        sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool= Pool(int(self.nproc))
+        signal.signal(signal.SIGINT, sigint_handler)
+        entries= []
+        try:
+            for entry in pool.imap_unordered(compare_file, jobs):
+                print(f"{entry['status']:>9}  {relpath(entry['file'], ref)}")
+                entries.append(entry)
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        for entry in entries:
+            entry['file']= relpath(entry['file'], ref)
+        entries.sort(key=lambda entry: entry['file'])
+
+        summary= {}
+        for entry in entries:
+            summary[entry['status']]= summary.get(entry['status'], 0)+1
+
+        with open(self.report, 'w') as f:
+            json.dump({'ref': ref, 'outroot': outroot, 'summary': summary, 'files': entries}, f, indent=2)
+
+        print(summary)
+        if set(summary)-{'identical', 'pass'}:
+            exit(1)
+
+
+if __name__ == '__main__':
+    App.run()
@@ -6,6 +6,7 @@ import pandas as pd
 
 REL_DIFF_MAX = 1
 DICE_COEFF_MIN = 0.95
+WORST_LABELS = 10
 
 def test_header(params):
 
@@ -15,13 +16,27 @@ def test_header(params):
     np.testing.assert_almost_equal(gt_data.affine, out_data.affine)
 
 
-def test_data(params):
+def image_rel_diff(gt_name, out_name):
+    '''Relative percentage difference of two images of the same shape,
+    accumulated over slices of the last axis so that a 4D image is never fully loaded'''
+
+    gt_data= load(gt_name).dataobj
+    out_data= load(out_name).dataobj
+
+    diff= total= 0
+    for i in range(gt_data.shape[-1]):
+        gt_slice= np.asanyarray(gt_data[..., i], dtype='float64')
+        out_slice= np.asanyarray(out_data[..., i], dtype='float64')
+        diff+= abs(gt_slice - out_slice).sum()
+        total+= (gt_slice + out_slice).sum()
+
+    return 2 * diff / total * 100
+
 
-    gt_data= load(params['gt_name']).get_fdata()
-    out_data= load(params['out_name']).get_fdata()
+def test_data(params):
 
     # relative percentage difference
-    rel_diff = 2 * abs(gt_data - out_data).sum() / (gt_data + out_data).sum() * 100
+    rel_diff = image_rel_diff(params['gt_name'], params['out_name'])
     print(f'Difference {rel_diff}%')
     np.testing.assert_array_less(rel_diff, REL_DIFF_MAX)
 
@@ -68,25 +83,48 @@ def test_html(params):
     np.testing.assert_equal(gt_data, out_data)
 
 
-def test_wmparc(params):
+def read_labels(filename):
+    '''Integer label array of a nifti image, read without scaling to float64'''
 
-    gt_data= load(params['gt_name'])
-    out_data= load(params['out_name'])
+    data= np.asanyarray(load(filename).dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        data= np.rint(data).astype(np.int64)
 
-    ref_labels = gt_data.get_fdata()
-    out_labels = out_data.get_fdata()
+    return data
 
-    labels= np.unique(ref_labels)
 
-    dice_coeff = labels.copy()
-    for i, l in enumerate(labels):
-        temp_ref = (ref_labels == l) * 1
-        temp_out = (out_labels == l) * 1
+def label_dice(ref_labels, out_labels):
+    '''Dice coefficient of each label of ref_labels, computed from one confusion matrix of the two label arrays.
+    Returns (labels, dice)'''
+
+    assert ref_labels.shape==out_labels.shape, \
+        f'Label images differ in shape: {ref_labels.shape} vs {out_labels.shape}'
+
+    labels, codes= np.unique(np.concatenate((ref_labels.ravel(), out_labels.ravel())), return_inverse=True)
+    ref_codes, out_codes= np.split(codes.ravel(), 2)
+
+    n= len(labels)
+    confusion= np.bincount(ref_codes*n+out_codes, minlength=n*n).reshape(n, n)
+    ref_count= confusion.sum(1)
+    out_count= confusion.sum(0)
+
+    keep= ref_count>0
+    dice= 2*np.diag(confusion)/(ref_count+out_count)
+
+    return labels[keep], dice[keep]
+
+
+def test_wmparc(params):
+
+    ref_labels= read_labels(params['gt_name'])
+    out_labels= read_labels(params['out_name'])
 
-        intersection = (temp_ref * temp_out).sum()
-        dice = 2 * intersection / (temp_ref.sum() + temp_out.sum())
+    labels, dice_coeff= label_dice(ref_labels, out_labels)
 
-        dice_coeff[i]= dice
+    order= np.argsort(dice_coeff)[:WORST_LABELS]
+    print('Worst labels:')
+    for l, d in zip(labels[order], dice_coeff[order]):
+        print(f'{l:>8} {d:.4f}')
 
     np.testing.assert_array_less(DICE_COEFF_MIN, dice_coeff.min())
 
@@ -1,39 +1,14 @@
 #!/usr/bin/env python
 import numpy
-import vtk
 import nibabel
 
-def read_polydata(filename):
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(filename)
-    reader.Update()
-    outpd = reader.GetOutput()
-    del reader
-
-    return outpd
+# streamline density is computed by scripts/tract_density.py, on PYTHONPATH as for the other scripts
+from tract_density import read_polydata, line_points, tract_density
 
 
 def convert_cluster_to_volume(inpd, volume):
 
-    volume_shape = volume.get_fdata().shape
-    new_voxel_data = numpy.zeros(volume_shape)
-
-    inpoints = inpd.GetPoints()
-
-    inpd.GetLines().InitTraversal()
-    for _ in range(0, inpd.GetNumberOfLines()):
-        ptids = vtk.vtkIdList()
-        inpd.GetLines().GetNextCell(ptids)
-
-        for pidx in range(0, ptids.GetNumberOfIds()):
-            point = inpoints.GetPoint(ptids.GetId(pidx))
-
-            point_ijk = nibabel.affines.apply_affine(numpy.linalg.inv(volume.affine), point)
-            point_ijk = numpy.rint(point_ijk).astype(numpy.int32)
-
-            new_voxel_data[(point_ijk[0], point_ijk[1], point_ijk[2])] += 1
-
-    return new_voxel_data
+    return tract_density(line_points(inpd), volume.shape, volume.affine)
 
 
 def calc_dice(voxel_data_1, voxel_data_2):
@@ -68,5 +43,3 @@ def tract2vol(tract_name, volume_name):
     inpd= read_polydata(tract_name)
     volume = nibabel.load(volume_name)
     return convert_cluster_to_volume(inpd, volume)
-
-
@@ -2,13 +2,14 @@
 
 import argparse
 from conversion import read_cases
-from luigi import build, configuration
+from luigi import build, configuration, Task, Event
 from _define_outputs import IO
 from struct_pipe import StructMask, Freesurfer
 from dwi_pipe import DwiAlign, GibbsUn, CnnMask, \
     PnlEddy, FslEddy, TopupEddy, HcpPipe, EddyEpi, Ukf
 from fs2dwi_pipe import Fs2Dwi, Wmql, Wmqlqc, TractMeasures
-from scripts.util import abspath, isfile, pjoin, LIBDIR
+from _priority import set_priority
+from scripts.util import abspath, isfile, pjoin, LIBDIR, clear_read_cache
 from os import getenv, stat, remove
 from tempfile import gettempdir
 from glob import glob
@@ -237,6 +238,17 @@ if __name__ == '__main__':
                                           dwi_template=args.dwi_template))
 
 
+    # long poles of the cohort first
+    set_priority(jobs)
+
+    # uncompressed copies of the inputs of a case are removed once its job is done
+    job_ids= {job.task_id for job in jobs}
+
+    @Task.event_handler(Event.SUCCESS)
+    def _clear_read_cache(task):
+        if task.task_id in job_ids:
+            clear_read_cache(task.id, task.ses)
+
     build(jobs, workers=args.num_workers)
 
 
@@ -0,0 +1,111 @@
+from luigi import configuration, ExternalTask
+from os.path import isfile
+from statistics import median
+import sqlite3
+
+from _task_util import _input_images, _image_bytes
+
+GB= 1024**3
+
+# seconds of a task that is not in the task history: fixed + per GB of its nifti inputs as float32
+DURATION= {
+    'StructAlign': (60, 120),
+    'StructMask': (1800, 0),
+    'N4BiasCorrect': (300, 0),
+    'Freesurfer': (6*3600, 0),
+    'DwiAlign': (60, 120),
+    'GibbsUn': (60, 600),
+    'CnnMask': (300, 300),
+    'BseExtract': (10, 30),
+    'BseMask': (30, 0),
+    'PnlEddy': (300, 3600),
+    'FslEddy': (1800, 7200),
+    'EddyEpi': (1200, 600),
+    'TopupEddy': (3600, 7200),
+    'Ukf': (1800, 1800),
+    'Wma800': (2*3600, 0),
+    'Fs2Dwi': (1200, 0),
+    'Wmql': (1800, 0),
+    'TractMeasures': (300, 0),
+    'Wmqlqc': (60, 0),
+}
+
+
+def _history_durations():
+    '''Median seconds from RUNNING to DONE of each task family in the task history database of luigi.cfg,
+    empty if there is no history on this machine'''
+
+    config= configuration.get_config()
+    db= config.get('task_history', 'db_connection', '').split('sqlite:///')
+    # same as _deps_tree.get_record_id(), the database must be local
+    if len(db)<2 or not isfile(db[1]):
+        return {}
+
+    conn= sqlite3.connect(db[1])
+    try:
+        rows= conn.execute('''SELECT tasks.name, (julianday(done.ts)-julianday(running.ts))*86400
+            FROM tasks
+            JOIN task_events running ON running.task_id=tasks.id AND running.event_name='RUNNING'
+            JOIN task_events done ON done.task_id=tasks.id AND done.event_name='DONE'
+            WHERE done.ts>=running.ts''').fetchall()
+    except sqlite3.Error:
+        return {}
+    finally:
+        conn.close()
+
+    seconds= {}
+    for name, duration in rows:
+        seconds.setdefault(name, []).append(duration)
+
+    return {name: median(durations) for name, durations in seconds.items()}
+
+
+def _duration(task, history):
+    '''Expected seconds of a task: from the task history, else estimated from the headers of its inputs'''
+
+    if isinstance(task, ExternalTask):
+        return 0
+
+    family= task.get_task_family()
+    if family in history:
+        return history[family]
+
+    fixed, per_gb= DURATION.get(family, (60, 0))
+    try:
+        size= _image_bytes(_input_images(task))/GB if per_gb else 0
+    except Exception:
+        size= 0
+
+    return fixed+ per_gb*size
+
+
+def set_priority(jobs):
+    '''Set the priority of each task to the expected seconds from its start to the end of its job,
+    i.e. the critical path remaining when the task starts, so that the long poles of a cohort start first.
+    The scheduler raises the priority of a dependency to that of its dependents,
+    which keeps these priorities since a dependency always has more time remaining.'''
+
+    history= _history_durations()
+    duration= {}
+    remaining= {}
+
+    def visit(task, after):
+        if task.task_id not in duration:
+            duration[task.task_id]= _duration(task, history)
+
+        total= after+ duration[task.task_id]
+        if remaining.get(task.task_id, -1)>=total:
+            return
+        remaining[task.task_id]= total
+        task.priority= int(total)
+
+        try:
+            deps= task.deps()
+        except Exception:
+            # reported by the scheduler
+            deps= []
+        for dep in deps:
+            visit(dep, total)
+
+    for job in jobs:
+        visit(job, 0)
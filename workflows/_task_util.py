@@ -1,4 +1,10 @@
 from plumbum import local
+from luigi import configuration
+from luigi.task import flatten
+from os.path import isfile
+import nibabel
+import numpy as np
+
 
 def _mask_name(mask_name, mask_qc=True):
 
@@ -18,4 +24,57 @@ Once you are done, save the (edited) mask as {}
     
     else:
         print(msg)
-        return mask_name
\ No newline at end of file
+        return mask_name
+
+
+MB= 1024**2
+NIFTI_EXT= ('.nii', '.nii.gz')
+
+
+def _node_resources():
+    '''Totals of the [resources] section in luigi.cfg, the scheduler limits running tasks to them'''
+
+    config= configuration.get_config()
+    return {name: config.getint('resources', name) for name in ['cpu', 'memory', 'gpu']
+            if config.has_option('resources', name)}
+
+
+def _input_images(task):
+    '''Existing nifti inputs of a task, an input that is not created yet is replaced by
+    the inputs of the task creating it: the pipeline keeps the grid of the raw images'''
+
+    images= set()
+    for req in flatten(task.requires()):
+        outputs= [out for out in flatten(req.output()) if str(out).endswith(NIFTI_EXT)]
+        found= [str(out) for out in outputs if isfile(out)]
+        images.update(found if found else _input_images(req))
+
+    return images
+
+
+def _image_bytes(images, dtype='float32'):
+    '''Size of images in memory as dtype: voxels x volumes x itemsize, read from the headers only'''
+
+    itemsize= np.dtype(dtype).itemsize
+    return sum(int(np.prod(nibabel.load(img).shape, dtype=np.int64))*itemsize for img in images)
+
+
+def _resources(task, cpu=1, copies=0, base=0, gpu=0):
+    '''Luigi resources of a task: cpu cores, memory in MB and gpu devices.
+    Memory is base MB plus copies times the float32 size of the nifti inputs of the task.
+    Amounts are capped at the totals in luigi.cfg so that a large task can still run alone.
+    Resources without a total are not declared because the scheduler assumes a total of 1 for them.'''
+
+    total= _node_resources()
+    if 'memory' in total:
+        try:
+            image= _image_bytes(_input_images(task)) if copies else 0
+        except Exception:
+            # inputs unreadable at scheduling time, the task reports its own error when it runs
+            image= 0
+        memory= base+ int(np.ceil(copies*image/MB))
+    else:
+        memory= 0
+
+    needed= dict(cpu=max(1, int(cpu)), memory=memory, gpu=int(gpu))
+    return {name: min(amount, total[name]) for name, amount in needed.items() if name in total and amount}
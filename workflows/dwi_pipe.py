@@ -13,10 +13,10 @@ from time import sleep
 import re
 
 from struct_pipe import StructMask
-from _task_util import _mask_name
+from _task_util import _mask_name, _resources
 
 from scripts.util import N_PROC, B0_THRESHOLD, BET_THRESHOLD, QC_POLL, LIBDIR, \
-    load_nifti, TemporaryDirectory
+    load_nifti, TemporaryDirectory, cpu_slots
 N_PROC= int(N_PROC)
 
 from _glob import _glob
@@ -44,6 +44,10 @@ class DwiAlign(Task):
     
     derivatives_dir= Parameter()
     
+    @property
+    def resources(self):
+        return _resources(self, copies=3, base=200)
+
     def run(self):
         self.output()['dwi'].dirname.mkdir()
 
@@ -72,13 +76,18 @@ class GibbsUn(Task):
 
     unring_nproc= IntParameter(default=N_PROC)
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.unring_nproc, copies=4, base=200)
+
     def run(self):
-        cmd = (' ').join(['unring.py',
-                          self.input()['dwi'],
-                          self.output()['dwi'].rsplit('.nii.gz')[0],
-                          str(self.unring_nproc)])
-        p = Popen(cmd, shell=True)
-        p.wait()
+        with cpu_slots(self.unring_nproc) as nproc:
+            cmd = (' ').join(['unring.py',
+                              self.input()['dwi'],
+                              self.output()['dwi'].rsplit('.nii.gz')[0],
+                              str(nproc)])
+            p = Popen(cmd, shell=True)
+            p.wait()
         
         write_provenance(self, self.output()['dwi'])
 
@@ -99,6 +108,10 @@ class CnnMask(Task):
     percentile= IntParameter(default=99)
     filter= Parameter(default='')
 
+    @property
+    def resources(self):
+        return _resources(self, copies=4, base=4000)
+
     def run(self):
         
         with (TemporaryDirectory() as tmpdir, local.cwd(tmpdir)):
@@ -156,6 +169,10 @@ class BseExtract(Task):
     b0_threshold= FloatParameter(default=float(B0_THRESHOLD))
     which_bse= Parameter(default='')
 
+    @property
+    def resources(self):
+        return _resources(self, copies=2, base=200)
+
     def run(self):
 
         cmd = (' ').join(['bse.py',
@@ -183,6 +200,10 @@ class BseMask(Task):
     mask_method = Parameter(default='Bet')
     model_folder= Parameter(default='')
 
+    @property
+    def resources(self):
+        return _resources(self, copies=2, base=200)
+
     def run(self):
         
         if self.mask_method=='Bet':
@@ -218,19 +239,24 @@ class PnlEddy(Task):
     eddy_nproc = IntParameter(default=N_PROC)
     mask_qc= BoolParameter(default=True)
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.eddy_nproc, copies=3, base=200*self.eddy_nproc)
+
     def run(self):
         
         for name in ['dwi', 'bval', 'bvec']:
             if not self.output()[name].exists():
-                cmd = (' ').join(['pnl_eddy.py',
-                                  '-i', self.input()[0]['dwi'],
-                                  '--bvals', self.input()[0]['bval'],
-                                  '--bvecs', self.input()[0]['bvec'],
-                                  '-o', self.output()['dwi'].rsplit('.nii.gz')[0],
-                                  '-d' if self.debug else '',
-                                  f'-n {self.eddy_nproc}' if self.eddy_nproc else ''])
-                p = Popen(cmd, shell=True)
-                p.wait()
+                with cpu_slots(self.eddy_nproc or N_PROC) as nproc:
+                    cmd = (' ').join(['pnl_eddy.py',
+                                      '-i', self.input()[0]['dwi'],
+                                      '--bvals', self.input()[0]['bval'],
+                                      '--bvecs', self.input()[0]['bvec'],
+                                      '-o', self.output()['dwi'].rsplit('.nii.gz')[0],
+                                      '-d' if self.debug else '',
+                                      f'-n {nproc}'])
+                    p = Popen(cmd, shell=True)
+                    p.wait()
 
                 break
 
@@ -261,6 +287,10 @@ class FslEddy(Task):
     
     FslOutDir= Parameter(default='fsl_eddy')
     
+    @property
+    def resources(self):
+        return _resources(self, copies=12, base=1000, gpu=self.useGpu)
+
     def run(self):
         
         outDir= self.output()['dwi'].dirname.join(self.FslOutDir)
@@ -331,25 +361,30 @@ class EddyEpi(Task):
             raise ValueError('Supported eddy tasks are {PnlEddy,FslEddy}. '
                 f'Correct the value of eddy_task in {getenv("LUIGI_CONFIG_PATH")}')
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.epi_nproc, copies=3, base=1500)
+
     def run(self):
 
         eddy_epi_prefix = self.output()['dwi'].rsplit('.nii.gz')[0]
 
         for name in ['dwi', 'bval', 'bvec']:
             if not self.output()[name].exists():
-                cmd = (' ').join(['pnl_epi.py',
-                                  '--dwi', self.input()['eddy']['dwi'],
-                                  '--bvals', self.input()['eddy']['bval'],
-                                  '--bvecs', self.input()['eddy']['bvec'],
-                                  '--dwimask', self.input()['eddy']['mask'],
-                                  '--bse', self.input()['eddy']['bse'],
-                                  '--t2', self.input()['t2']['aligned'],
-                                  '--t2mask', self.input()['t2']['mask'],
-                                  '-o', eddy_epi_prefix,
-                                  '-d' if self.debug else '',
-                                  f'-n {self.epi_nproc}' if self.epi_nproc else ''])
-                p = Popen(cmd, shell=True)
-                p.wait()
+                with cpu_slots(self.epi_nproc or N_PROC) as nproc:
+                    cmd = (' ').join(['pnl_epi.py',
+                                      '--dwi', self.input()['eddy']['dwi'],
+                                      '--bvals', self.input()['eddy']['bval'],
+                                      '--bvecs', self.input()['eddy']['bvec'],
+                                      '--dwimask', self.input()['eddy']['mask'],
+                                      '--bse', self.input()['eddy']['bse'],
+                                      '--t2', self.input()['t2']['aligned'],
+                                      '--t2mask', self.input()['t2']['mask'],
+                                      '-o', eddy_epi_prefix,
+                                      '-d' if self.debug else '',
+                                      f'-n {nproc}'])
+                    p = Popen(cmd, shell=True)
+                    p.wait()
 
                 move(f'{eddy_epi_prefix}_mask.nii.gz', self.output()['mask'])
 
@@ -421,6 +456,10 @@ class TopupEddy(Task):
         
         return (pa, pa_mask, ap, ap_mask)
 
+    @property
+    def resources(self):
+        return _resources(self, copies=12, base=1000, gpu=self.useGpu)
+
     def run(self):
         
         mask_pa= _mask_name(self.input()[1]['mask'], self.mask_qc)
@@ -628,6 +667,10 @@ class Ukf(Task):
                 f'Correct the value of eddy_epi_task in {getenv("LUIGI_CONFIG_PATH")}')
 
 
+    @property
+    def resources(self):
+        return _resources(self, copies=4, base=2000)
+
     def run(self):
         self.output().dirname.mkdir()
 
@@ -660,20 +703,25 @@ class Wma800(Task):
     xvfb= IntParameter(default=1)
     wma_cleanup= IntParameter(default=0)
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.wma_nproc, base=2000*self.wma_nproc)
+
     def run(self):
 
-        cmd = (' ').join(['wm_apply_ORG_atlas_to_subject.sh',
-                          '-i', self.input(),
-                          '-a', self.atlas,
-                          f'-s "{self.slicer_exec}"',
-                          f'-m "{self.FiberTractMeasurements}"',
-                          f'-x {self.xvfb}',
-                          f'-n {self.wma_nproc}',
-                          f'-c {self.wma_cleanup}',
-                          '-d 1',
-                          '-o', self.output()])
-        p = Popen(cmd, shell=True)
-        p.wait()
+        with cpu_slots(self.wma_nproc) as nproc:
+            cmd = (' ').join(['wm_apply_ORG_atlas_to_subject.sh',
+                              '-i', self.input(),
+                              '-a', self.atlas,
+                              f'-s "{self.slicer_exec}"',
+                              f'-m "{self.FiberTractMeasurements}"',
+                              f'-x {self.xvfb}',
+                              f'-n {nproc}',
+                              f'-c {self.wma_cleanup}',
+                              '-d 1',
+                              '-o', self.output()])
+            p = Popen(cmd, shell=True)
+            p.wait()
 
         write_provenance(self)
 
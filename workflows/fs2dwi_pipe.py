@@ -8,13 +8,14 @@ from struct_pipe import Freesurfer, StructMask
 from plumbum import local
 from subprocess import Popen
 
-from scripts.util import N_PROC
+from scripts.util import N_PROC, cpu_slots
 
 from os.path import dirname, join as pjoin
 from _glob import _glob
 from glob import glob
 
 from _provenance import write_provenance
+from _task_util import _resources
 
 class SelectFsDwiFiles(ExternalTask):
     id = Parameter()
@@ -78,6 +79,10 @@ class Fs2Dwi(Task):
             return self.clone(SelectFsDwiFiles),
 
 
+    @property
+    def resources(self):
+        return _resources(self, copies=16, base=500)
+
     def run(self):
         cmd = (' ').join(
             [
@@ -113,18 +118,23 @@ class Wmql(Task):
     query= Parameter(default='')
     wmql_nproc= IntParameter(default= int(N_PROC))
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.wmql_nproc, base=1000*self.wmql_nproc)
+
     def run(self):
         # obtain the tract from dwi prefix
         tract= self.input()[1].replace('/dwi/', '/tracts/').replace('_dwi.nii.gz', '.vtk')
 
-        cmd = (' ').join(['wmql.py',
-                          '-f', self.input()[0],
-                          '-i', tract,
-                          '-o', self.output(),
-                          f'-q {self.query}' if self.query else '',
-                          f'-n {self.wmql_nproc}' if self.wmql_nproc else ''])
-        p = Popen(cmd, shell=True)
-        p.wait()
+        with cpu_slots(self.wmql_nproc or N_PROC) as nproc:
+            cmd = (' ').join(['wmql.py',
+                              '-f', self.input()[0],
+                              '-i', tract,
+                              '-o', self.output(),
+                              f'-q {self.query}' if self.query else '',
+                              f'-n {nproc}'])
+            p = Popen(cmd, shell=True)
+            p.wait()
 
         write_provenance(self)
 
@@ -138,6 +148,10 @@ class TractMeasures(Task):
 
     exe= Parameter()
 
+    @property
+    def resources(self):
+        return _resources(self, base=500)
+
     def run(self):
 
         cmd = (' ').join([self.exe,
@@ -162,6 +176,10 @@ class Wmqlqc(Task):
     id = Parameter()
     ses = Parameter(default='')
 
+    @property
+    def resources(self):
+        return _resources(self, base=500)
+
     def run(self):
         cmd = (' ').join(['wmqlqc.py',
                           '-i', self.input(),
@@ -11,9 +11,9 @@ from plumbum import local
 from subprocess import Popen, check_call
 from time import sleep
 
-from scripts.util import N_PROC, FILEDIR, QC_POLL
+from scripts.util import N_PROC, FILEDIR, QC_POLL, cpu_slots
 
-from _task_util import _mask_name
+from _task_util import _mask_name, _resources
 from _glob import _glob
 from _provenance import write_provenance
 
@@ -35,6 +35,10 @@ class StructAlign(Task):
     
     derivatives_dir= Parameter()
     
+    @property
+    def resources(self):
+        return _resources(self, copies=3, base=200)
+
     def run(self):
         self.output().dirname.mkdir()
 
@@ -73,6 +77,8 @@ class StructMask(Task):
     debug= BoolParameter(default= False)
     fusion= Parameter(default= '')
     mabs_mask_nproc= IntParameter(default= int(N_PROC))
+    mabs_template= Parameter(default= '')
+    mabs_select= IntParameter(default= 0)
 
     # for hd-bet
     hdbet_mode= Parameter(default= '')
@@ -84,18 +90,33 @@ class StructMask(Task):
     reg_method= Parameter(default='rigid')
 
 
+    @property
+    def resources(self):
+        if self.mask_method.lower()=='mabs':
+            # one antsRegistration for each of the training images registered in parallel
+            return _resources(self, cpu=self.mabs_mask_nproc, copies=16*self.mabs_mask_nproc, base=500)
+        elif self.mask_method.lower()=='hd-bet':
+            return _resources(self, copies=10, base=4000, gpu=self.hdbet_device!='cpu')
+        else:
+            return _resources(self, copies=16, base=500)
+
     def run(self):
 
         if self.mask_method.lower() in ['mabs','hd-bet']:
 
             if self.mask_method.lower()=='mabs':
-                cmd = (' ').join(['atlas.py',
-                                  '-t', self.input(),
-                                  '--train', self.csvFile,
-                                  '-o', self.output()['mask'].rsplit('_mask.nii.gz')[0],
-                                  f'-n {self.mabs_mask_nproc}',
-                                  '-d' if self.debug else '',
-                                  f'--fusion {self.fusion}' if self.fusion else ''])
+                with cpu_slots(self.mabs_mask_nproc) as nproc:
+                    cmd = (' ').join(['atlas.py',
+                                      '-t', self.input(),
+                                      '--train', self.csvFile,
+                                      '-o', self.output()['mask'].rsplit('_mask.nii.gz')[0],
+                                      f'-n {nproc}',
+                                      '-d' if self.debug else '',
+                                      f'--fusion {self.fusion}' if self.fusion else '',
+                                      f'--template {self.mabs_template}' if self.mabs_template else '',
+                                      f'--select {self.mabs_select}' if self.mabs_select else ''])
+                    p = Popen(cmd, shell=True)
+                    p.wait()
 
             elif self.mask_method.lower()=='hd-bet':
                 cmd = (' ').join(['hd-bet',
@@ -105,11 +126,11 @@ class StructMask(Task):
                                   f'-device {self.hdbet_device}' if self.hdbet_device else '',
                                   '&& rm', self.output()['mask'].replace('_mask','')])
                                   # the trailing part removes hd-bet's masked image
+                p = Popen(cmd, shell=True)
+                p.wait()
 
             else:
                 raise ValueError('Supported structural masking methods are MABS and HD-BET only')
-            p = Popen(cmd, shell=True)
-            p.wait()
 
             # print instruction for quality checking
             _mask_name(self.output()['mask'], False)
@@ -190,6 +211,10 @@ class N4BiasCorrect(Task):
     
     mask_qc= BoolParameter(default=True)
     
+    @property
+    def resources(self):
+        return _resources(self, copies=8, base=200)
+
     def run(self):
         
         # ensure existence of quality checked MABS mask
@@ -279,28 +304,33 @@ class Freesurfer(Task):
 
 
 
+    @property
+    def resources(self):
+        return _resources(self, cpu=self.freesurfer_nproc, base=6000 if self.subfields else 4000)
+
     def run(self):
-        cmd = (' ').join(
-            [
-                'fs.py',
-                '-i',
-                self.input()[0]['n4corr'],
-                '-o',
-                self.output(),
-                f'-n {self.freesurfer_nproc}',
-                f'--expert {self.expert_file}' if self.expert_file else '',
-                '--nohires' if self.no_hires else '',
-                '--noskullstrip',
-                '--norandomness' if self.no_rand else '',
-                '--subfields' if self.subfields else '',
-                f"--t2 {self.input()[1]['n4corr']}" if self.t2_template else '',
-            ]
-        )
-
-
-        # DONOT remove the trailing comment, used for pipeline_test.sh: --hack-fs
-        p = Popen(cmd, shell=True) # fs-exec
-        p.wait()
+        with cpu_slots(self.freesurfer_nproc) as nproc:
+            cmd = (' ').join(
+                [
+                    'fs.py',
+                    '-i',
+                    self.input()[0]['n4corr'],
+                    '-o',
+                    self.output(),
+                    f'-n {nproc}',
+                    f'--expert {self.expert_file}' if self.expert_file else '',
+                    '--nohires' if self.no_hires else '',
+                    '--noskullstrip',
+                    '--norandomness' if self.no_rand else '',
+                    '--subfields' if self.subfields else '',
+                    f"--t2 {self.input()[1]['n4corr']}" if self.t2_template else '',
+                ]
+            )
+
+
+            # DONOT remove the trailing comment, used for pipeline_test.sh: --hack-fs
+            p = Popen(cmd, shell=True) # fs-exec
+            p.wait()
 
         check_call(f'recon-all --version > {self.output()}/version.txt', shell=True)
 